@@ -171,7 +171,10 @@ Parse.Cloud.define('getReads', async (request) => {
   }
 });
 
-/* Get md5 checksum. */
+/* Get md5 checksum.
+ * The checksum is calculated in the background. This returns a job, which is
+ * polled with getMd5Status until its status is done.
+ */
 Parse.Cloud.define('getMd5', async (request) => {
   const user = request.user;
   if (user == undefined || user == null) {
@@ -202,6 +205,60 @@ Parse.Cloud.define('getMd5', async (request) => {
   }
 });
 
+/* Get status of md5 checksum job. */
+Parse.Cloud.define('getMd5Status', async (request) => {
+  const user = request.user;
+  if (user == undefined || user == null) {
+    throw 'Must be logged in';
+  }
+  var jobId = request.params.jobId;
+
+  try {
+    var response = await Parse.Cloud.httpRequest({
+      method: 'POST',
+      url: `http://webhook:5000/read/md5/${jobId}`,
+      followRedirects: true
+    });
+  } catch (e) {
+    return {'error': 'httprequest error'};
+  }
+  var data = response.data;
+
+  if (!('result' in data) ){
+    throw data;
+  } else {
+    return data.result;
+  }
+});
+
+/* Start md5 checksum jobs for all reads of a project. */
+Parse.Cloud.define('getProjectMd5', async (request) => {
+  const user = request.user;
+  if (user == undefined || user == null) {
+    throw 'Must be logged in';
+  }
+  const sessionToken = user.getSessionToken();
+  var objectId = request.params.objectId;
+
+  try {
+    var response = await Parse.Cloud.httpRequest({
+      method: 'POST',
+      url: `http://webhook:5000/project/${objectId}/md5`,
+      followRedirects: true,
+      params: { sessionToken }
+    });
+  } catch (e) {
+    return {'error': 'httprequest error'};
+  }
+  var data = response.data;
+
+  if (!('result' in data) ){
+    throw data;
+  } else {
+    return data.result;
+  }
+});
+
 /* Set samples. */
 Parse.Cloud.define('setSamples', async (request) => {
   const user = request.user;
@@ -520,6 +577,13 @@ Parse.Cloud.define('getOutput', async (request) => {
   const sessionToken = user.getSessionToken();
 
   var objectId = request.params.objectId;
+  var offset = request.params.offset;
+
+  // Only send output after the given byte offset, if given.
+  var params = { sessionToken };
+  if (offset != undefined && offset != null) {
+    params.offset = offset;
+  }
 
   // Send request to webhook.
   try {
@@ -527,17 +591,17 @@ Parse.Cloud.define('getOutput', async (request) => {
       method: 'POST',
       url: 'http://webhook:5000/job/' + objectId + '/output',
       followRedirects: true,
-      params: { sessionToken }
+      params: params
     });
   } catch (e) {
     return {'error': 'httprequest error'};
   }
   var data = response.data;
 
-  console.log(data);
-
   if (!('result' in data) ){
     throw data;
+  } else if ('cursor' in data) {
+    return data;
   } else {
     return data.result;
   }
@@ -938,6 +1002,26 @@ async function enqueueJob(job) {
   job.set('queuePosition', await getNextQueuePosition());
   job.set('archive', false);
   await job.save();
+
+  notifyQueue();
+}
+
+// Wakes up the worker, which long-polls the webhook for queue changes.
+// Failed notifications are retried a few times. The worker also checks the
+// queue periodically, in case all of them fail.
+function notifyQueue(attempt = 0) {
+  Parse.Cloud.httpRequest({
+    method: 'POST',
+    url: 'http://webhook:5000/queue/notify',
+    followRedirects: true
+  }).then(function(httpResponse) {
+    console.log(httpResponse.data);
+  }, function(httpResponse) {
+    console.error('Queue notification failed with response code ' + httpResponse.status);
+    if (attempt < 3) {
+      setTimeout(notifyQueue, 1000 * Math.pow(2, attempt), attempt + 1);
+    }
+  });
 }
 
 // Gets the next queue position as an integer.
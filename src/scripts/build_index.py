@@ -17,8 +17,15 @@ sentry_sdk.init(os.getenv('SENTRY_DSN', ''), environment=os.getenv('ENVIRONMENT'
 from sentry_sdk import configure_scope
 
 import sys
+import glob
+import json
 import time
+import shutil
+import hashlib
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from utilities import run_sys
+from catalog import open_catalog
 import datetime as dt
 import subprocess as sp
 
@@ -37,49 +44,315 @@ from parse_rest.connection import ParseBatcher
 from parse_rest.core import ResourceRequestBadRequest, ParseError
 register(PARSE_APP_ID, '', master_key=PARSE_MASTER_KEY)
 
-def build_bowtie2(reference, nthreads=1):
+def sha256sum(path, chunk_size=16 * 1024 * 1024):
+    """
+    Calculates the sha256 checksum of the given file.
+    """
+    hash_sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hash_sha256.update(chunk)
+
+    return hash_sha256.hexdigest()
+
+def tool_version(args):
+    """
+    Returns the first line of the version output of a tool.
+    """
+    output = sp.check_output(args, stderr=sp.STDOUT, universal_newlines=True)
+    return output.strip().split('\n')[0]
+
+def index_files(out_path):
+    """
+    Returns the files of the index with the given path. Bowtie2 indices are
+    given as a prefix of several files, while kallisto indices are a single
+    file.
+    """
+    if os.path.isfile(out_path):
+        return [out_path]
+    return sorted(glob.glob(out_path + '.*.bt2') + glob.glob(out_path + '.*.bt2l'))
+
+class IndexCache:
+    """
+    Content-addressed store of built indices, keyed by the checksum of the
+    FASTA file, the tool and the tool version. Each entry is a directory
+    with the index files and a manifest of their sizes and checksums, which
+    is verified before the entry is reused.
+    """
+    def __init__(self, directory, catalog=None):
+        self.directory = directory
+        self.catalog = catalog
+        os.makedirs(directory, exist_ok=True)
+
+    def fasta_checksum(self, path):
+        """
+        Returns the checksum of a FASTA file. The checksum is saved in the
+        reference catalog, or next to the file if there is no catalog, and
+        reused as long as the file does not change.
+        """
+        if self.catalog is not None:
+            return self.catalog.checksum(path)
+
+        stat = os.stat(path)
+        identity = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        checksum_path = path + '.sha256'
+
+        if os.path.isfile(checksum_path):
+            with open(checksum_path, 'r') as f:
+                saved = json.load(f)
+            if saved.get('identity') == identity:
+                return saved['sha256']
+
+        checksum = sha256sum(path)
+        with open(checksum_path, 'w') as f:
+            json.dump({'identity': identity, 'sha256': checksum}, f)
+
+        return checksum
+
+    def entry(self, tool, version, fasta):
+        key = hashlib.sha256('{}\0{}\0{}'.format(
+            tool, version, self.fasta_checksum(fasta)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, tool, key)
+
+    def _link(self, src, dst):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            # The cache is on a different file system.
+            os.symlink(src, dst)
+
+    def fetch(self, entry, out_path):
+        """
+        Links the index files of the entry to the given index path if the
+        entry exists and is intact. Returns whether the index was fetched.
+        """
+        manifest_path = os.path.join(entry, 'manifest.json')
+        if not os.path.isfile(manifest_path):
+            return False
+
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+        for suffix, info in manifest.items():
+            path = os.path.join(entry, 'index' + suffix)
+            if not os.path.isfile(path) or os.path.getsize(path) != info['size'] \
+               or sha256sum(path) != info['sha256']:
+                print('cached index {} is corrupt'.format(entry), file=sys.stderr)
+                shutil.rmtree(entry, ignore_errors=True)
+                return False
+
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        for suffix in manifest:
+            self._link(os.path.join(entry, 'index' + suffix), out_path + suffix)
+
+        return True
+
+    def store(self, entry, out_path):
+        """
+        Adds the index files with the given index path to the cache.
+        """
+        if os.path.isdir(entry):
+            return
+
+        # Write to a temporary directory first, so that an interrupted store
+        # does not leave a partial entry.
+        tmp = '{}.tmp{}'.format(entry, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        manifest = {}
+        for path in index_files(out_path):
+            suffix = path[len(out_path):]
+            cached_path = os.path.join(tmp, 'index' + suffix)
+            try:
+                os.link(path, cached_path)
+            except OSError:
+                shutil.copyfile(path, cached_path)
+            manifest[suffix] = {'size': os.path.getsize(path),
+                                'sha256': sha256sum(path)}
+
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=4)
+
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another build stored the same index first.
+            shutil.rmtree(tmp, ignore_errors=True)
+
+def build_info(logfile):
+    """
+    Returns the checksum of the input and the tool version that were recorded
+    at the end of the log of a successful build, or None.
+    """
+    if not os.path.isfile(logfile):
+        return None
+
+    with open(logfile, 'r') as f:
+        lines = f.read().rstrip('\n').split('\n')
+
+    prefix = '# success '
+    if not lines[-1].startswith(prefix):
+        return None
+    try:
+        return json.loads(lines[-1][len(prefix):])
+    except ValueError:
+        return None
+
+def build_cached(name, fasta, out_path, args, version_args, logfile,
+                 cache=None):
+    """
+    Builds an index with the given command, unless it can be reused from the
+    cache or from a previous build that finished successfully. A previous
+    build is only reused if it was built from the same input with the same
+    tool version, which are recorded at the end of its log.
+    """
+    version = tool_version(version_args)
+    checksum = cache.fasta_checksum(fasta) if cache is not None else sha256sum(fasta)
+    info = {'sha256': checksum, 'version': version}
+
+    entry = None
+    if cache is not None:
+        entry = cache.entry(name, version, fasta)
+        if cache.fetch(entry, out_path):
+            print('reusing cached {} index'.format(name), file=sys.stderr)
+            with open(logfile, 'w') as f:
+                f.write('# success {}\n'.format(json.dumps(info, sort_keys=True)))
+            return
+
+    # The index was built, but the reference was not marked as built
+    # (i.e. the build was interrupted afterwards).
+    if build_info(logfile) == info and index_files(out_path):
+        print('reusing previously built {} index'.format(name), file=sys.stderr)
+    else:
+        if os.path.isfile(logfile):
+            os.remove(logfile)
+
+        # Make output directory.
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        # Existing index files may be hard links to cached ones, which must
+        # not be overwritten in place.
+        for path in index_files(out_path):
+            os.remove(path)
+
+        output = run_sys(args, prefix=name, file=logfile)
+
+        # if execution comes here, the command ran successfully
+        with open(logfile, 'a') as f:
+            f.write('# success {}\n'.format(json.dumps(info, sort_keys=True)))
+
+    if cache is not None:
+        cache.store(entry, out_path)
+
+def build_bowtie2(reference, nthreads=1, cache=None):
     """
     Builds bowtie2 index.
     """
     print('building bowtie index', file=sys.stderr)
-    logfile = os.path.join(reference.paths['root'], 'bowtie2_log.txt')
-    if os.path.isfile(logfile):
-        os.remove(logfile)
-
     dna_path = reference.paths['dna']
     out_path = reference.paths['bowtieIndex']
 
-    # Make output directory.
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-
     args = ['bowtie2-build', dna_path, out_path, '--threads', nthreads]
-    output = run_sys(args, prefix='bowtie2', file=logfile)
+    logfile = os.path.join(reference.paths['root'], LOGS['bowtieBuilt'])
+    build_cached('bowtie2', dna_path, out_path, args,
+                 ['bowtie2-build', '--version'], logfile, cache=cache)
 
-    # if execution comes here, the command ran successfully
-    with open(logfile, 'a') as f:
-        f.write('# success')
-
-def build_kallisto(reference, nthreads=1):
+def build_kallisto(reference, nthreads=1, cache=None):
     """
     Builds kallisto index.
     """
     print('building kallisto index', file=sys.stderr)
-    logfile = os.path.join(reference.paths['root'], 'kallisto_log.txt')
-    if os.path.isfile(logfile):
-        os.remove(logfile)
-
     cdna_path = reference.paths['cdna']
     out_path = reference.paths['kallistoIndex']
 
-    # Make output directory.
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-
     args = ['kallisto', 'index', '-i', out_path, cdna_path]
-    output = run_sys(args, prefix='kallisto', file=logfile)
+    logfile = os.path.join(reference.paths['root'], LOGS['kallistoBuilt'])
+    build_cached('kallisto', cdna_path, out_path, args,
+                 ['kallisto', 'version'], logfile, cache=cache)
+
+# The build log of each index.
+LOGS = {
+    'bowtieBuilt': 'bowtie2_log.txt',
+    'kallistoBuilt': 'kallisto_log.txt',
+}
 
-    # if execution comes here, the command ran successfully
-    with open(logfile, 'a') as f:
-        f.write('# success')
+# Each index has a flag on the reference that is set once it is built.
+INDICES = {
+    'bowtieBuilt': build_bowtie2,
+    'kallistoBuilt': build_kallisto,
+}
+
+# The reference file each index is built from.
+INPUTS = {
+    'bowtieBuilt': 'dna',
+    'kallistoBuilt': 'cdna',
+}
+
+def split_index_threads(flags, nthreads):
+    """
+    Splits the thread budget between the indices to build.
+    Kallisto index building is single-threaded, so it is given one thread
+    and bowtie2 is given the rest.
+    """
+    if len(flags) == 1:
+        return {flags[0]: nthreads}
+
+    return {'bowtieBuilt': max(1, nthreads - 1), 'kallistoBuilt': 1}
+
+def build(reference, nthreads=1, cache=None, catalog=None):
+    """
+    Builds the bowtie2 and kallisto indices of the reference concurrently.
+    Indices that are already built are skipped, so that a failed build only
+    has to be repeated for the index that failed. If a reference catalog is
+    given, indices whose input file changed since they were built are built
+    again.
+    """
+    if catalog is not None:
+        directories = set(os.path.dirname(reference.paths[kind])
+                          for kind in INPUTS.values())
+        for directory in directories:
+            catalog.refresh_directory(directory)
+            changed = catalog.changed(directory)
+            for flag, kind in INPUTS.items():
+                if kind in changed and \
+                   os.path.dirname(reference.paths[kind]) == directory:
+                    print('{} changed since last build'.format(kind), file=sys.stderr)
+                    setattr(reference, flag, False)
+
+                    # The previous build must not be reused.
+                    logfile = os.path.join(reference.paths['root'], LOGS[flag])
+                    if os.path.isfile(logfile):
+                        os.remove(logfile)
+
+    flags = [flag for flag in INDICES if not getattr(reference, flag, False)]
+    threads = split_index_threads(flags, nthreads) if flags else {}
+    lock = Lock()
+
+    def helper(flag):
+        INDICES[flag](reference, threads[flag], cache=cache)
+        if catalog is not None:
+            path = reference.paths[INPUTS[flag]]
+            catalog.mark_built(os.path.dirname(path), [INPUTS[flag]])
+
+        # Both builds save the same object.
+        with lock:
+            setattr(reference, flag, True)
+            reference.save()
+
+    with ThreadPoolExecutor(max_workers=max(1, len(flags))) as executor:
+        futures = [executor.submit(helper, flag) for flag in flags]
+
+    # Raise the first error only once all builds are finished.
+    for future in futures:
+        future.result()
+
+    # Success. This reference is ready to be used.
+    reference.indexBuilt = True
+    reference.ready = True
+    reference.save()
 
 if __name__ == '__main__':
     import argparse
@@ -94,21 +367,21 @@ if __name__ == '__main__':
     with configure_scope() as scope:
         scope.user = {'id': objectId}
 
-        # Get number of threads.
+        # Get number of threads. The webhook sets THREADS to the number of
+        # cpus given to this container.
         config = Config.get()
-        nthreads = config['threads']
-
+        nthreads = int(os.getenv('THREADS', config['threads']))
 
         # Get reference object.
         Reference = Object.factory('Reference')
         reference = Reference.Query.get(objectId=objectId)
 
-        # Build bowtie2 index.
-        build_bowtie2(reference, nthreads)
-
-        # Build kallisto index.
-        build_kallisto(reference, nthreads)
+        # Indices are cached across references and versions.
+        cache_dir = config.get('indexCacheDir',
+                               os.path.join(config['dataPath'], 'index_cache'))
+        catalog = open_catalog(config)
+        cache = IndexCache(cache_dir, catalog=catalog)
 
-        # Success. This reference is ready to be used.
-        reference.ready = True
-        reference.save()
+        # Build bowtie2 and kallisto indices.
+        build(reference, nthreads, cache=cache, catalog=catalog)
+        catalog.close()
@@ -0,0 +1,265 @@
+'''
+Contains class to keep a persistent catalog of the organisms tree.
+'''
+import os
+import sqlite3
+import hashlib
+from threading import Lock
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    kind TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    built_size INTEGER,
+    built_mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+'''
+
+def file_kind(fname):
+    '''
+    Classifies a file in a reference directory by its name.
+    Returns one of bed, annotation, cdna and dna, or None.
+    '''
+    if fname.endswith('.bed'):
+        return 'bed'
+    elif '_annotation' in fname:
+        return 'annotation'
+    elif '_cdna' in fname:
+        return 'cdna'
+    elif '_dna' in fname:
+        return 'dna'
+    return None
+
+def open_catalog(config):
+    '''
+    Opens the reference catalog of the given server config.
+    '''
+    path = config.get('referenceCatalog',
+                      os.path.join(config['dataPath'], 'references.sqlite'))
+    return ReferenceCatalog(path)
+
+class ReferenceCatalog:
+    '''
+    SQLite catalog of the genus/species/version/reference directories of the
+    organisms tree, and the files in each reference directory.
+    The tree is refreshed incrementally: a directory is listed again only if
+    its modification time changed, and known reference files are checked
+    with a single stat each.
+    Each file also records its size and modification time at the time the
+    indices were last built from it, so that changed inputs can be detected.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _delete_tree(self, path):
+        prefix = path + os.sep
+        for table, column in [('directories', 'path'), ('files', 'directory')]:
+            self.conn.execute(
+                'DELETE FROM {0} WHERE {1} = ? OR substr({1}, 1, ?) = ?'
+                .format(table, column), (path, len(prefix), prefix))
+
+    def _subdirectories(self, path):
+        '''
+        Returns the subdirectories of the given directory, listing it only
+        if it changed since it was last listed.
+        '''
+        mtime = os.stat(path).st_mtime_ns
+        row = self.conn.execute('SELECT mtime_ns FROM directories WHERE path = ?',
+                                (path,)).fetchone()
+        if row is not None and row[0] == mtime:
+            return [r[0] for r in self.conn.execute(
+                'SELECT path FROM directories WHERE parent = ?', (path,))]
+
+        children = []
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            if os.path.isdir(child):
+                children.append(child)
+
+        known = [r[0] for r in self.conn.execute(
+            'SELECT path FROM directories WHERE parent = ?', (path,))]
+        for child in set(known) - set(children):
+            self._delete_tree(child)
+
+        # New subdirectories are listed when they are visited.
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO directories (path, parent, mtime_ns) '
+            'VALUES (?, ?, NULL)', [(child, path) for child in children])
+        self.conn.execute(
+            'INSERT OR REPLACE INTO directories (path, parent, mtime_ns) '
+            'VALUES (?, (SELECT parent FROM directories WHERE path = ?), ?)',
+            (path, path, mtime))
+
+        return children
+
+    def _refresh_files(self, directory):
+        '''
+        Updates the files of the given reference directory.
+        '''
+        known = {r[0]: (r[1], r[2]) for r in self.conn.execute(
+            'SELECT path, size, mtime_ns FROM files WHERE directory = ?',
+            (directory,))}
+        mtime = os.stat(directory).st_mtime_ns
+        row = self.conn.execute('SELECT mtime_ns FROM directories WHERE path = ?',
+                                (directory,)).fetchone()
+
+        if row is not None and row[0] == mtime:
+            paths = list(known)
+        else:
+            paths = [os.path.join(directory, fname) for fname in os.listdir(directory)]
+            self.conn.execute(
+                'INSERT OR REPLACE INTO directories (path, parent, mtime_ns) '
+                'VALUES (?, ?, ?)', (directory, os.path.dirname(directory), mtime))
+
+        for path in set(known) - set(paths):
+            self.conn.execute('DELETE FROM files WHERE path = ?', (path,))
+
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.conn.execute('DELETE FROM files WHERE path = ?', (path,))
+                continue
+            identity = (stat.st_size, stat.st_mtime_ns)
+
+            if path not in known:
+                # Files are assumed to match any indices that already exist
+                # when they are first seen.
+                self.conn.execute(
+                    'INSERT INTO files (path, directory, kind, size, mtime_ns, '
+                    'built_size, built_mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (path, directory, file_kind(os.path.basename(path)),
+                     *identity, *identity))
+            elif known[path] != identity:
+                self.conn.execute(
+                    'UPDATE files SET size = ?, mtime_ns = ?, sha256 = NULL '
+                    'WHERE path = ?', (*identity, path))
+
+    def refresh_directory(self, directory):
+        '''
+        Updates the files of a single reference directory.
+        '''
+        with self.lock, self.conn:
+            self._refresh_files(directory)
+
+    def refresh(self, organism_path, reference_dir):
+        '''
+        Updates the catalog from the organisms tree, which has the structure
+        genus/species/version/reference_dir.
+        '''
+        with self.lock, self.conn:
+            for genus_path in self._subdirectories(organism_path):
+                for species_path in self._subdirectories(genus_path):
+                    for version_path in self._subdirectories(species_path):
+                        reference_path = os.path.join(version_path, reference_dir)
+                        if os.path.isdir(reference_path):
+                            self._refresh_files(reference_path)
+                        else:
+                            self._delete_tree(reference_path)
+
+    def references(self, organism_path, reference_dir):
+        '''
+        Returns all reference directories in the organisms tree, as a list
+        of dictionaries with the genus, species, version, version path and
+        the path of each kind of file.
+        '''
+        prefix = organism_path.rstrip(os.sep) + os.sep
+        references = {}
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT directory, kind, path FROM files '
+                'WHERE substr(directory, 1, ?) = ? ORDER BY path',
+                (len(prefix), prefix)).fetchall()
+
+        for directory, kind, path in rows:
+            parts = os.path.relpath(directory, organism_path).split(os.sep)
+            if len(parts) != 4 or parts[3] != reference_dir:
+                continue
+
+            if directory not in references:
+                references[directory] = {'genus': parts[0],
+                                         'species': parts[1],
+                                         'version': parts[2],
+                                         'path': os.path.dirname(directory),
+                                         'files': {}}
+            if kind is not None:
+                references[directory]['files'][kind] = path
+
+        return list(references.values())
+
+    def checksum(self, path, chunk_size=16 * 1024 * 1024):
+        '''
+        Returns the sha256 checksum of the given file. The checksum is
+        calculated only if the file changed since it was last calculated.
+        '''
+        stat = os.stat(path)
+        identity = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime_ns, sha256 FROM files '
+                                    'WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[2] is not None and (row[0], row[1]) == identity:
+            return row[2]
+
+        hash_sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                hash_sha256.update(chunk)
+        checksum = hash_sha256.hexdigest()
+
+        with self.lock, self.conn:
+            if row is None:
+                directory = os.path.dirname(path)
+                self.conn.execute(
+                    'INSERT INTO files (path, directory, kind, size, mtime_ns, '
+                    'sha256, built_size, built_mtime_ns) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, directory, file_kind(os.path.basename(path)),
+                     *identity, checksum, *identity))
+            else:
+                self.conn.execute(
+                    'UPDATE files SET size = ?, mtime_ns = ?, sha256 = ? '
+                    'WHERE path = ?', (*identity, checksum, path))
+
+        return checksum
+
+    def changed(self, directory):
+        '''
+        Returns the kinds of files in the given reference directory that
+        changed since the indices were last built from them.
+        '''
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT kind FROM files WHERE directory = ? AND kind IS NOT NULL '
+                'AND (size != built_size OR mtime_ns != built_mtime_ns)',
+                (directory,)).fetchall()
+
+        return sorted(set(r[0] for r in rows))
+
+    def mark_built(self, directory, kinds):
+        '''
+        Records that the indices were built from the current version of the
+        files of the given kinds in the reference directory.
+        '''
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'UPDATE files SET built_size = size, built_mtime_ns = mtime_ns '
+                'WHERE directory = ? AND kind = ?',
+                [(directory, kind) for kind in kinds])
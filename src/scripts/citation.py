@@ -0,0 +1,52 @@
+'''
+Contains helper functions to construct the data processing citations of
+samples, shared by the webhook and the compile script.
+'''
+
+def kallisto_flags(sample, config):
+    '''
+    Returns the flags kallisto was run with for the given sample.
+    '''
+    arg = '-b {} --bias'.format(config['kallistoBootstraps'])
+
+    if sample.readType == 'single':
+        arg += ' --single -l {} -s {}'.format(sample.readLength,
+                                              sample.readStd)
+
+    return arg
+
+def sample_citation_info(sample, config):
+    '''
+    Constructs the data processing citation of a sample.
+
+    Arguments:
+    sample -- (parse_rest Sample) sample with its reference and organism loaded
+    config -- (dict) server config
+
+    Returns: (list) of citation strings
+    '''
+    genus = sample.reference.organism.genus
+    species = sample.reference.organism.species
+    ref_version = sample.reference.version
+
+    format_dict = {'genus': genus,
+                   'species': species,
+                   'ref_version': ref_version,
+                   'arg': kallisto_flags(sample, config),
+                   **config}
+
+    info = ['RNA-seq data was analyzed with the Alaska pipeline (alaska.caltech.edu).',
+            ('Quality control was performed using using Bowtie2 (v{versionBowtie}), '
+             'Samtools (v{versionSamtools}), RSeQC (v{versionRseqc}), '
+             'FastQC (v{versionFastqc}), with results aggregated with '
+             'MultiQC (v{versionMultiqc}).').format(**format_dict),
+            ('Reads were aligned to the {genus} {species} genome version {ref_version} '
+             'as provided by Wormbase using Kallisto (v{versionKallisto}) with the following '
+             'flags: {arg}').format(**format_dict),
+            ('Differential expression analyses with Sleuth (v{versionSleuth}) '
+             'were performed using a Wald Test corrected for multiple-testing.').format(**format_dict)]
+
+    if genus == 'caenorhabditis' and species == 'elegans':
+        info.append('Enrichment analysis was performed using the Wormbase Enrichment Suite.')
+
+    return info
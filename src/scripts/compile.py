@@ -1,5 +1,4 @@
 import os
-import tarfile
 PARSE_HOSTNAME = os.getenv('PARSE_HOSTNAME', 'http://parse-server:1337/parse')
 PARSE_APP_ID = os.getenv('PARSE_APP_ID', 'alaska')
 PARSE_MASTER_KEY = os.getenv('PARSE_MASTER_KEY', 'MASTER_KEY')
@@ -18,6 +17,9 @@ register(PARSE_APP_ID, '', master_key=PARSE_MASTER_KEY)
 # Setup for parse_rest
 os.environ["PARSE_API_ROOT"] = PARSE_HOSTNAME
 
+from utilities import open_tar, write_tar, write_tar_to
+from citation import sample_citation_info
+
 def format_indicator(indicator, value):
     """
     Helper function to format indicators in soft format.
@@ -42,10 +44,60 @@ def format_attribute(attribute, value):
     """
     return '!{} = {}\n'.format(attribute, value)
 
-def get_series(project):
+def query_all(query, limit=1000):
+    """
+    Helper function to fetch every object matching a query, one page of
+    `limit` objects per request.
+
+    Arguments:
+    query -- (parse_rest.query.Queryset) query to fetch
+    limit -- (int) number of objects per request
+
+    Returns: (list) of objects
+    """
+    results = []
+    while True:
+        page = list(query.limit(limit).skip(len(results)))
+        results.extend(page)
+        if len(page) < limit:
+            return results
+
+def prefetch(project):
+    """
+    Fetch everything needed to write the soft file of a project with a
+    constant number of queries, instead of several per sample.
+    Samples are fetched with their references and organisms included,
+    and all reads of all samples are fetched together.
+
+    Arguments:
+    project -- (parse_rest Project) project to prefetch
+
+    Returns: (dict) with keys samples, reads (objectId -> list of reads
+             of that sample, by objectId), jobs and config
+    """
+    print('prefetching project {}'.format(project.objectId), flush=True)
+
+    samples = query_all(project.relation('samples').query().order_by('createdAt')
+                        .select_related('reference', 'reference.organism'))
+
+    Read = Object.factory('Read')
+    reads = {sample.objectId: {} for sample in samples}
+    if samples:
+        for read in query_all(Read.Query.filter(sample__in=samples)
+                              .order_by('createdAt')):
+            reads[read.sample.objectId][read.objectId] = read
+
+    jobs = list(project.relation('jobs').query().order_by('analysis.step'))
+
+    return {'samples': samples,
+            'reads': reads,
+            'jobs': jobs,
+            'config': Config.get()}
+
+def get_series(project, data):
     print('getting series for project {}'.format(project.objectId), flush=True)
 
-    samples = project.relation('samples').query()
+    samples = data['samples']
     series = ''
 
     series += format_indicator('SERIES', project.objectId)
@@ -85,9 +137,8 @@ def get_series(project):
         series += format_attribute('Series_sample_id', sample.objectId)
 
     # Add supplementary files for project-wide analysis.
-    jobs = project.relation('jobs').query().order_by('analysis.step')
     project_jobs = []
-    for job in jobs:
+    for job in data['jobs']:
         if job.analysis.type == 'project':
             project_jobs.append(job)
 
@@ -108,7 +159,7 @@ def get_series(project):
 
     return series, supplementary
 
-def get_sample(sample):
+def get_sample(sample, reads, config):
     print('getting sample for sample {}'.format(sample.objectId), flush=True)
 
     sample_soft = ''
@@ -155,13 +206,12 @@ def get_sample(sample):
                    sample.metadata['library preparation'])
     sample_soft += format_attribute('Sample_library_strategy', 'RNA-Seq')
 
-    infos = Function('sampleCitation')(objectId=sample.objectId)
+    infos = sample_citation_info(sample, config)
     for info in infos:
         sample_soft += format_attribute('Sample_data_processing', info)
 
     sample_soft += format_attribute('Sample_description', sample.metadata['description'])
 
-    reads = sample.relation('reads').query()
     if sample.readType == 'single':
         # construct values
         files = []
@@ -170,7 +220,7 @@ def get_sample(sample):
         lengths = []
         stds = []
 
-        for read in reads:
+        for read in reads.values():
             basename = os.path.basename(read.path)
             arcname = '{}_{}'.format(name, basename)
             extension = os.path.splitext(basename)[1]
@@ -195,13 +245,13 @@ def get_sample(sample):
     elif sample.readType == 'paired':
         for i, pair_id in enumerate(sample.readPairs):
             run = str(i + 1)
-            pair = [reads.get(objectId=pair_id[0]), reads.get(objectId=pair_id[1])]
+            pair = [reads[pair_id[0]], reads[pair_id[1]]]
             files = []
             types = []
             md5s = []
 
             for read in pair:
-                basename = os.path.basename(read)
+                basename = os.path.basename(read.path)
                 arcname = '{}_{}'.format(name, basename)
                 ext = os.path.splitext(basename)[1]
                 files.append(arcname)
@@ -251,14 +301,18 @@ def write_soft(project, soft_file='seq_info.txt'):
     soft = ''
     supplementary = {}
 
+    data = prefetch(project)
+
     # Get project soft.
-    project_soft, project_supplementary = get_series(project)
+    project_soft, project_supplementary = get_series(project, data)
     soft += project_soft
     supplementary = project_supplementary
 
     # Get sample softs.
-    for sample in project.relation('samples').query():
-        sample_soft, sample_supplementary = get_sample(sample)
+    for sample in data['samples']:
+        sample_soft, sample_supplementary = get_sample(sample,
+                                                       data['reads'][sample.objectId],
+                                                       data['config'])
         soft += '\n' + sample_soft
 
         for s in sample_supplementary:
@@ -267,40 +321,101 @@ def write_soft(project, soft_file='seq_info.txt'):
 
         supplementary = {**supplementary, **sample_supplementary}
 
-    # Write to soft file.
+    # Write to soft file. An unchanged soft file is left untouched, so that
+    # a streamed archive stays identical and its upload can be resumed.
     soft_path = os.path.join(project.paths['root'], soft_file)
-    with open(soft_path, 'w') as f:
-        f.write(soft)
+    if os.path.isfile(soft_path):
+        with open(soft_path, 'r') as f:
+            unchanged = f.read() == soft
+    else:
+        unchanged = False
+    if not unchanged:
+        with open(soft_path, 'w') as f:
+            f.write(soft)
     supplementary[soft_file] = soft_path
 
     return soft_path, supplementary
 
+def archive_settings():
+    """
+    Helper function to get the compression level and number of threads to
+    archive with. The GEO submission archive is always compressed.
+
+    Returns: (int, int) of compression level and number of threads
+    """
+    config = Config.get()
+    level = max(1, config.get('archiveLevel', 6))
+    nthreads = os.cpu_count() or 1
+
+    return level, nthreads
+
+def archive_items(supplementary):
+    items = []
+    for file, path in supplementary.items():
+        print(file, path, flush=True)
+        items.append((path, file))
+
+    return items
+
 def archive(project, supplementary, arcname='geo_submission.tar.gz'):
     print('archiving project {}'.format(project.objectId), flush=True)
+    level, nthreads = archive_settings()
 
     # Archive.
     archive_path = os.path.join(project.paths['root'], arcname)
-    with tarfile.open(archive_path, 'w:gz') as tar:
-        for file, path in supplementary.items():
-            print(file, path, flush=True)
-            tar.add(path, arcname=file)
+    return write_tar(archive_path, archive_items(supplementary), level=level,
+                     nthreads=nthreads)
+
+def stream_archive(project, supplementary, fileobj):
+    """
+    Writes the GEO submission archive to the given binary file object
+    (i.e. a pipe to an FTP upload) instead of a file on disk.
+    The file object is closed once the archive is written.
+    """
+    print('streaming archive of project {}'.format(project.objectId), flush=True)
+    level, nthreads = archive_settings()
 
-    return archive_path
+    writer = open_tar(fileobj, level=level, nthreads=nthreads)
+    try:
+        write_tar_to(writer, archive_items(supplementary), level=level)
+    finally:
+        writer.close()
 
-def compile(project, arcname='geo_submission.tar.gz'):
+def compile(project, arcname='geo_submission.tar.gz', stream=None,
+            progress=None):
+    """
+    Compiles the project for GEO submission. If stream is True (or the
+    geoStream config is set), only the soft file is written, and the archive
+    is streamed directly to the GEO when the project is uploaded.
+    progress is called with a dictionary of each step as it is started.
+    """
     print('compiling project {}'.format(project.objectId), flush=True)
-    soft_path, supplementary = write_soft(project)
-    archive_path = archive(project, supplementary, arcname)
+    if stream is None:
+        stream = Config.get().get('geoStream', False)
+    if progress is None:
+        progress = lambda step: None
 
+    progress({'step': 'soft'})
+    soft_path, supplementary = write_soft(project)
     project.files['soft'] = soft_path
-    project.files['geo'] = archive_path
+
+    if stream:
+        project.files['geo'] = None
+    else:
+        progress({'step': 'archive', 'files': len(supplementary)})
+        project.files['geo'] = archive(project, supplementary, arcname)
     project.save()
+    progress({'step': 'done'})
 
-def run_compile(objectId):
+def run_compile(objectId, progress=None):
+    """
+    Compiles the project with the given objectId. progress may be a queue
+    that the progress of the compilation is put into.
+    """
     Project = Object.factory('Project')
     project = Project.Query.get(objectId=objectId)
 
-    compile(project)
+    compile(project, progress=progress.put if progress is not None else None)
 
 if __name__ == '__main__':
     import argparse
@@ -3,30 +3,222 @@ Contains class to send and receive queries to and from Parse Server.
 '''
 import json
 import requests
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def _relationData(field, className, ids, op):
+    '''
+    Helper function to generate the data to add or remove Relations.
+    '''
+    # Generate data to send.
+    # The data contain an 'objects' key.
+    # This is a list of dictionaries, one for each idsToAdd.
+    # Each dictionary contains '__type': 'Pointer', 'className', and
+    # 'objectId'.
+    objects = []
+    for _id in ids:
+        objects.append({'__type': 'Pointer',
+                        'className': className,
+                        'objectId': _id})
+    return {field: {'__op': op,
+                    'objects': objects}}
+
+def _checkPaging(constraints):
+    '''
+    Helper function to reject constraints that conflict with paging over
+    all objects, which is always ordered by objectId.
+    '''
+    keys = [key for key in ('order', 'skip', 'limit') if key in constraints]
+    if keys:
+        raise ValueError('{} cannot be used when fetching all objects, which '
+                         'are ordered by objectId'.format(', '.join(keys)))
+
+class BatchResult:
+    '''
+    Result of a single operation in a ParseBatch.
+    Either result or error is set once the batch is flushed.
+    '''
+    def __init__(self, method, path, body):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.done = False
+        self.result = None
+        self.error = None
+
+    @property
+    def success(self):
+        return self.done and self.error is None
+
+    def __repr__(self):
+        return '<BatchResult {} {} {}>'.format(self.method, self.path,
+                                               self.error or self.result)
+
+class ParseBatch:
+    '''
+    Queue of write operations that are sent to Parse Server with the /batch
+    endpoint, which accepts up to 50 operations per request.
+    Use with ParseQuery.batch():
+
+    with query.batch() as batch:
+        result = batch.create('classes/Reads', {'path': <PATH>})
+    print(result.result['objectId'])
+    '''
+    MAX_SIZE = 50
+
+    def __init__(self, query, use_master=False, raise_errors=False):
+        self.query = query
+        self.use_master = use_master
+        self.raise_errors = raise_errors
+        self.queue = []
+        self.errors = []
+
+        # Paths in batch requests must include the mount path (i.e. /parse).
+        self.root = urlparse(query.hostname).path.rstrip('/')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def _add(self, method, endpoint, body=None):
+        result = BatchResult(method, self.root + '/' + endpoint, body)
+        self.queue.append(result)
+
+        if len(self.queue) >= self.MAX_SIZE:
+            self.flush()
+
+        return result
+
+    def create(self, endpoint, obj):
+        return self._add('POST', endpoint, obj)
+
+    def update(self, endpoint, objectId, obj):
+        return self._add('PUT', endpoint + '/' + objectId, obj)
+
+    def delete(self, endpoint, objectId):
+        return self._add('DELETE', endpoint + '/' + objectId)
+
+    def addRelation(self, endpoint, objectId, field, className, idsToAdd):
+        data = _relationData(field, className, idsToAdd, 'AddRelation')
+        return self.update(endpoint, objectId, data)
+
+    def removeRelation(self, endpoint, objectId, field, className, idsToRemove):
+        data = _relationData(field, className, idsToRemove, 'RemoveRelation')
+        return self.update(endpoint, objectId, data)
+
+    def flush(self):
+        '''
+        Sends all queued operations, in requests of at most 50 operations.
+        Returns the list of failed operations.
+        '''
+        errors = []
+        while self.queue:
+            ops = self.queue[:self.MAX_SIZE]
+            self.queue = self.queue[self.MAX_SIZE:]
+
+            batch_requests = []
+            for op in ops:
+                request = {'method': op.method, 'path': op.path}
+                if op.body is not None:
+                    request['body'] = op.body
+                batch_requests.append(request)
+
+            r = self.query._post('batch', 'application/json',
+                                 json.dumps({'requests': batch_requests}),
+                                 self.use_master)
+            responses = r.json()
+            if not isinstance(responses, list):
+                raise Exception('batch request failed: {}'.format(responses))
+
+            # Responses are in the same order as the operations.
+            for op, response in zip(ops, responses):
+                op.done = True
+                if 'success' in response:
+                    op.result = response['success']
+                else:
+                    op.error = response.get('error', response)
+                    errors.append(op)
+
+        self.errors += errors
+        if errors and self.raise_errors:
+            raise Exception('{} batch operations failed: {}'.format(len(errors),
+                                                                    errors))
+
+        return errors
 
 class ParseQuery:
     '''
     Wrapper around requests module to easily send and receive queries
     to and from Parse Server.
+    All requests share a pooled session, so that connections are kept alive
+    between requests.
     '''
-    def __init__(self, hostname, appId, masterKey=None):
+    def __init__(self, hostname, appId, masterKey=None, pool_size=10,
+                 retries=3, backoff=0.5, timeout=30):
         '''
         Constructor.
+
+        Arguments:
+        hostname  -- (str) url of the Parse Server
+        appId     -- (str) application id
+        masterKey -- (str) master key
+        pool_size -- (int) maximum number of connections to keep alive
+        retries   -- (int) number of times to retry a request that failed with
+                           a connection error or 5xx response
+        backoff   -- (float) backoff factor between retries, in seconds
+        timeout   -- (float) timeout of each request, in seconds
         '''
         self.hostname = hostname
         self.appId = appId
         self.masterKey = masterKey
+        self.timeout = timeout
+        self._headers = {}
+
+        # POST requests are not retried on 5xx responses, because
+        # they are not idempotent.
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      backoff_factor=backoff,
+                      status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def _makeUrl(self, endpoint):
         return self.hostname + '/' + endpoint
 
     def _makeHeaders(self, content_type, use_master):
-        headers = {"X-Parse-Application-Id": self.appId,
-                   "Content-Type": content_type}
-        if use_master:
-            headers['X-Parse-Master-Key'] = self.masterKey
+        # Headers are only constructed once for each combination.
+        key = (content_type, use_master)
+        if key not in self._headers:
+            headers = {"X-Parse-Application-Id": self.appId,
+                       "Content-Type": content_type}
+            if use_master:
+                headers['X-Parse-Master-Key'] = self.masterKey
+            self._headers[key] = headers
+
+        return self._headers[key]
+
+    def _request(self, method, url, headers, **kwargs):
+        '''
+        Sends an HTTP request through the pooled session.
+        '''
+        return self.session.request(method, url, headers=headers,
+                                    timeout=self.timeout, **kwargs)
 
-        return headers
+    def close(self):
+        '''
+        Closes all pooled connections.
+        '''
+        self.session.close()
 
     def _post(self, endpoint, content_type, data, use_master=True):
         '''
@@ -35,7 +227,7 @@ class ParseQuery:
         url = self._makeUrl(endpoint)
         headers = self._makeHeaders(content_type, use_master)
 
-        r = requests.post(url, headers=headers, data=data)
+        r = self._request('POST', url, headers, data=data)
 
         # TODO check response code
 
@@ -49,10 +241,9 @@ class ParseQuery:
         headers = self._makeHeaders('application/json', use_master)
 
         # Apply count constraints.
-        constraints['count'] = 1
-        constraints['limit'] = 0
+        constraints = {**constraints, 'count': 1, 'limit': 0}
 
-        r = requests.get(url, headers=headers, data=json.dumps(constraints))
+        r = self._request('GET', url, headers, data=json.dumps(constraints))
 
         return r.json()['count']
 
@@ -64,7 +255,7 @@ class ParseQuery:
         headers = self._makeHeaders('application/json', False)
 
 
-        r = requests.get(url, headers=headers, data=json.dumps(constraints))
+        r = self._request('GET', url, headers, data=json.dumps(constraints))
 
         return r.json()
 
@@ -79,6 +270,8 @@ class ParseQuery:
         constraints -- (dict) of search constraints (i.e. filters)
         All         -- (bool) whether or not to get every object
                               by default, API requests retrieve max 100 objects
+                              every object is ordered by objectId, so the
+                              constraints may not contain order, skip or limit
         use_master  -- (bool) whether or not to use the master key
 
         Returns:
@@ -94,23 +287,70 @@ class ParseQuery:
         http://docs.parseplatform.org/rest/guide/#queries
         for more info.
         '''
+        if all:
+            _checkPaging(constraints)
+            return list(self.iterate(endpoint, constraints, use_master))
+
         url = self._makeUrl(endpoint)
         headers = self._makeHeaders('application/json', use_master)
-        results = []
 
-        r = requests.get(url, headers=headers, data=json.dumps(constraints))
-        results += r.json()['results']
-
-        skip = 0
-        while all and r.json()['results']:
-            skip += 100
-            constraints['skip'] = skip
-            r = requests.get(url, headers=headers, data=json.dumps(constraints))
-            results += r.json()['results']
+        r = self._request('GET', url, headers, data=json.dumps(constraints))
 
         # TODO check response code
 
-        return results
+        return r.json()['results']
+
+    def iterate(self, endpoint, constraints={}, use_master=False, limit=1000):
+        '''
+        Generator that yields every object that matches the constraints,
+        ordered by objectId.
+        Pages are fetched with keyset pagination on objectId, instead of
+        skip, so that every page is equally fast to fetch. The next page is
+        requested while the current page is being processed.
+
+        Arguments:
+        endpoint    -- (str) path to the table you want to look up
+        constraints -- (dict) of search constraints (i.e. filters)
+        use_master  -- (bool) whether or not to use the master key
+        limit       -- (int) number of objects per page
+
+        Returns:
+        A generator of dictionaries of whatever was found.
+
+        Raises ValueError if the constraints contain order, skip or limit.
+        '''
+        _checkPaging(constraints)
+        url = self._makeUrl(endpoint)
+        headers = self._makeHeaders('application/json', use_master)
+        where = constraints.get('where', {})
+
+        def fetch(last):
+            page = {key: value for key, value in constraints.items()
+                    if key != 'where'}
+            page['limit'] = limit
+            page['order'] = 'objectId'
+
+            if last is None:
+                if where:
+                    page['where'] = where
+            else:
+                cursor = {'objectId': {'$gt': last}}
+                page['where'] = {'$and': [where, cursor]} if where else cursor
+
+            r = self._request('GET', url, headers, data=json.dumps(page))
+            return r.json()['results']
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            results = fetch(None)
+            while results:
+                future = None
+                if len(results) == limit:
+                    future = executor.submit(fetch, results[-1]['objectId'])
+
+                for result in results:
+                    yield result
+
+                results = future.result() if future is not None else []
 
     def getConfig(self):
         '''
@@ -119,7 +359,7 @@ class ParseQuery:
         url = self._makeUrl('config')
         headers = self._makeHeaders('application/json', False)
 
-        r = requests.get(url, headers=headers)
+        r = self._request('GET', url, headers)
 
         return r.json()['params']
 
@@ -172,7 +412,7 @@ class ParseQuery:
         url = self._makeUrl(endpoint + '/' + objectId)
         headers = self._makeHeaders('application/json', use_master)
 
-        r = requests.put(url, headers=headers, data=json.dumps(obj))
+        r = self._request('PUT', url, headers, data=json.dumps(obj))
 
         return r.json()
 
@@ -190,7 +430,7 @@ class ParseQuery:
         url = self._makeUrl(endpoint + '/' + objectId)
         headers = self._makeHeaders('application/json', use_master)
 
-        r = requests.delete(url, headers=headers)
+        r = self._request('DELETE', url, headers)
 
     def upload(self, file, fname, content_type, use_master=False):
         '''
@@ -256,18 +496,7 @@ class ParseQuery:
         '''
         Helper function to implement ParseQuery.addRelation and .removeRelation
         '''
-        # Generate data to send.
-        # The data contain an 'objects' key.
-        # This is a list of dictionaries, one for each idsToAdd.
-        # Each dictionary contains '__type': 'Pointer', 'className', and
-        # 'objectId'.
-        objects = []
-        for _id in ids:
-            objects.append({'__type': 'Pointer',
-                            'className': className,
-                            'objectId': _id})
-        data = {field: {'__op': op,
-                        'objects': objects}}
+        data = _relationData(field, className, ids, op)
 
         self.update(endpoint, objectId, data, use_master)
 
@@ -318,6 +547,28 @@ class ParseQuery:
         self._relation(endpoint, objectId, field, className, idsToRemove,
                        'RemoveRelation', use_master)
 
+    def batch(self, use_master=False, raise_errors=False):
+        '''
+        Returns a ParseBatch that queues create, update, delete, addRelation
+        and removeRelation operations, and sends them in /batch requests
+        when it is flushed (or when the with block exits).
+
+        Arguments:
+        use_master   -- (bool) whether or not to use the master key
+        raise_errors -- (bool) whether to raise an exception if any of the
+                               operations failed
+
+        Example:
+        If you want to add many wallpapers at once:
+        with ParseQuery.batch(True) as batch:
+            results = [batch.create('classes/Wallpapers', {'url': url})
+                       for url in urls]
+        objectIds = [result.result['objectId'] for result in results]
+
+        https://docs.parseplatform.org/rest/guide/#batch-operations
+        '''
+        return ParseBatch(self, use_master, raise_errors)
+
     def getRelated(self, endpoint, objectId, field, className):
         '''
         Get a list of objects in a particular relation field.
@@ -3,9 +3,10 @@ import sentry_sdk
 sentry_sdk.init(os.getenv('SENTRY_DIFF_DSN', ''))
 from sentry_sdk import configure_scope
 
+import glob
 import pandas as pd
 from utilities import run_sys, print_with_flush, mp_helper, \
-                      archive, archive_project
+                      archive, archive_project, StepCache, cached
 
 PARSE_HOSTNAME = os.getenv('PARSE_HOSTNAME', 'http://parse-server:1337/parse')
 PARSE_APP_ID = os.getenv('PARSE_APP_ID', 'alaska')
@@ -71,7 +72,21 @@ def run_sleuth(project, code='diff', requires='quant'):
     args += ['-o', project.paths[code]]
     args += ['-a', samples[0].reference.paths['annotation']]
 
-    run_sys(args, prefix=project.objectId)
+    # Skip sleuth if the kallisto results, design matrix, annotation and
+    # sleuth version did not change since the last run.
+    cache = StepCache(project.paths[code])
+    inputs = glob.glob(os.path.join(project.paths[requires], '*', 'abundance.h5'))
+    inputs += glob.glob(os.path.join(project.paths[requires], '*', 'run_info.json'))
+    inputs += [project.files[code]['matrix'], samples[0].reference.paths['annotation'],
+               sleuth_path]
+    params = {'version': config.get('versionSleuth'),
+              'args': args[2:]}
+
+    def sleuth():
+        run_sys(args, prefix=project.objectId)
+        return {'sleuth': object_path}
+
+    cached(cache, 'sleuth', inputs, params, sleuth)
 
     # Archive.
     archive_path = archive(project, code)
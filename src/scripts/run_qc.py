@@ -3,9 +3,13 @@ import sentry_sdk
 sentry_sdk.init(os.getenv('SENTRY_QC_DSN', ''), environment=os.getenv('ENVIRONMENT', 'default'))
 from sentry_sdk import configure_scope
 
+import glob
 import tarfile
-from utilities import run_sys, print_with_flush, mp_helper, \
-                      archive, archive_project
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from utilities import run_sys, run_pipe, print_with_flush, mp_helper, \
+                      echo_every, archive, archive_project, split_threads, \
+                      StepCache, cached
 
 PARSE_HOSTNAME = os.getenv('PARSE_HOSTNAME', 'http://parse-server:1337/parse')
 PARSE_APP_ID = os.getenv('PARSE_APP_ID', 'alaska')
@@ -22,6 +26,9 @@ from parse_rest.connection import ParseBatcher
 from parse_rest.core import ResourceRequestBadRequest, ParseError
 register(PARSE_APP_ID, '', master_key=PARSE_MASTER_KEY)
 
+# Number of reads to align for qc.
+BOWTIE2_UPTO = 10 ** 5
+
 def read_distribution(sample, code='qc'):
     """
     Helper function to run read_distribution.py
@@ -32,14 +39,12 @@ def read_distribution(sample, code='qc'):
     args += ['-i', sorted_path]
     args += ['-r', bed_path]
 
-    output = run_sys(args, prefix=sample.name)
-
     distribution_file = '{}_distribution.txt'.format(sample.name)
     distribution_path = os.path.join(sample.paths[code], distribution_file)
 
-    # output file
-    with open(distribution_path, 'w') as out:
-        out.write(output)
+    # Write the output directly to the file.
+    run_sys(args, prefix=sample.name, out=distribution_path,
+            echo=echo_every(100))
 
     return {'distribution': distribution_path}
 
@@ -75,10 +80,9 @@ def tin(sample, code='qc'):
     tin_file = '{}_tin.txt'.format(sample.name)
     tin_path = os.path.join(sample.paths[code], tin_file)
 
-    output = run_sys(args, prefix=sample.name)
-    # output file
-    with open(tin_path, 'w') as out:
-        out.write(output)
+    # The output scales with the number of transcripts, so write it directly
+    # to the file, and only echo some of it.
+    run_sys(args, prefix=sample.name, out=tin_path, echo=echo_every(1000))
 
     return {'tin': tin_path}
 
@@ -90,20 +94,13 @@ def fastqc(sample, code='qc'):
     args = ['fastqc', sorted_path]
     run_sys(args, prefix=sample.name)
 
-    return {}
+    fastqc_path = os.path.splitext(sorted_path)[0] + '_fastqc.html'
+    return {'fastqc': fastqc_path}
 
-def bowtie2(sample, code='qc', nthreads=1):
+def bowtie2_args(sample, nthreads=1):
     """
-    Helper function to call bowtie2 alignment.
+    Helper function to construct the bowtie2 command, without the output.
     """
-    upto = 10 ** 5
-
-    # Various path variables.
-    alignments_file = '{}_alignments.sam'.format(sample.name)
-    alignments_path = os.path.join(sample.paths[code], alignments_file)
-    info_file = '{}_align_info.txt'.format(sample.name)
-    info_path = os.path.join(sample.paths[code], info_file)
-
     args = ['bowtie2', '-x', sample.reference.paths['bowtieIndex']]
 
     # Fetch all reads for this sample.
@@ -122,15 +119,17 @@ def bowtie2(sample, code='qc', nthreads=1):
         args += ['-1', ','.join(m1)]
         args += ['-2', ','.join(m2)]
 
-
-    args += ['-S', alignments_path]
-    args += ['-u', str(upto)]
+    args += ['-u', str(BOWTIE2_UPTO)]
     args += ['--threads', str(nthreads)]
     args += ['--verbose']
-    output = run_sys(args, prefix=sample.name)
 
-    # Write bowtie stderr output.
-    first = '{} reads; of these'.format(upto)
+    return args
+
+def write_align_info(output, info_path):
+    """
+    Helper function to write the alignment summary in the bowtie2 output.
+    """
+    first = '{} reads; of these'.format(BOWTIE2_UPTO)
     last = 'overall alignment rate'
     found = False
     bt2_info = ''
@@ -148,10 +147,55 @@ def bowtie2(sample, code='qc', nthreads=1):
     with open(info_path, 'w') as f:
         f.write(bt2_info)
 
+def bowtie2(sample, code='qc', nthreads=1):
+    """
+    Helper function to call bowtie2 alignment.
+    """
+    # Various path variables.
+    alignments_file = '{}_alignments.sam'.format(sample.name)
+    alignments_path = os.path.join(sample.paths[code], alignments_file)
+    info_file = '{}_align_info.txt'.format(sample.name)
+    info_path = os.path.join(sample.paths[code], info_file)
+
+    args = bowtie2_args(sample, nthreads=nthreads)
+    args += ['-S', alignments_path]
+
+    # The alignment summary is at the end of the output.
+    output = run_sys(args, prefix=sample.name, tail=100)
+
+    # Write bowtie stderr output.
+    write_align_info(output, info_path)
+
     # Return dictionary of files.
     return {'alignments': alignments_path,
             'alignInfo': info_path}
 
+def bowtie2_sort(sample, code='qc', nthreads=1):
+    """
+    Helper function to call bowtie2 alignment, and pipe the alignments
+    directly to samtools sort, without writing the intermediate .sam file.
+    """
+    info_file = '{}_align_info.txt'.format(sample.name)
+    info_path = os.path.join(sample.paths[code], info_file)
+    sorted_file = '{}_sorted.bam'.format(sample.name)
+    sorted_path = os.path.join(sample.paths[code], sorted_file)
+
+    bt2_args = bowtie2_args(sample, nthreads=nthreads)
+
+    sort_args = ['samtools', 'sort', '-']
+    sort_args += ['-o', sorted_path]
+    sort_args += ['-@', str(nthreads-1)]
+    sort_args += ['-m', '2G']
+
+    # The alignment summary is at the end of the output.
+    bt2_output, _ = run_pipe([bt2_args, sort_args], prefix=sample.name, tail=100)
+
+    # Write bowtie stderr output.
+    write_align_info(bt2_output, info_path)
+
+    return {'alignInfo': info_path,
+            'sortedAlignments': sorted_path}
+
 def samtools_sort(sample, code='qc', nthreads=1):
     """
     Helper function to call samtools to sort .bam
@@ -178,6 +222,8 @@ def samtools_index(sample, code='qc', nthreads=1):
     args += ['-@', str(nthreads-1)]
     run_sys(args, prefix=sample.name)
 
+    return {'sortedIndex': sorted_path + '.bai'}
+
 def multiqc(sample, code='qc'):
     """
     Helper function to run multiqc.
@@ -191,9 +237,11 @@ def multiqc(sample, code='qc'):
 
     return {'multiqc': os.path.join(sample.paths[code], 'multiqc_report.html')}
 
-def qc(sample, code='qc', nthreads=1):
+def qc(sample, code='qc', nthreads=1, stream=True):
     '''
     Run QC on a single sample.
+    If stream is True, the alignments are sorted as they are written,
+    instead of being written to an intermediate .sam file.
     '''
     # Change working directory.
     original_wdir = os.getcwd()
@@ -203,36 +251,90 @@ def qc(sample, code='qc', nthreads=1):
 
     sample.files[code] = {}
 
-    # Align with bowtie2.
-    align_files = bowtie2(sample, code=code, nthreads=nthreads)
-    sample.files[code] = align_files
+    # Steps whose inputs, tool versions and arguments did not change since
+    # the last run are skipped.
+    config = Config.get()
+    cache = StepCache(sample.paths[code])
+    reference = sample.reference
+    reads = [(read.path, getattr(read, 'md5Checksum', None))
+             for read in sample.relation('reads').query()]
+    bowtie_index = glob.glob(reference.paths['bowtieIndex'] + '*')
+    bed_path = reference.paths['bed']
+
+    bt2_params = {'version': config.get('versionBowtie'),
+                  'upto': BOWTIE2_UPTO,
+                  'readType': sample.readType,
+                  'readPairs': getattr(sample, 'readPairs', None)}
+    params = {'version': config.get('versionSamtools')}
+    if stream:
+        # Align with bowtie2 and sort with samtools in a single pipeline.
+        sam_files = cached(cache, 'bowtie2_sort', reads + bowtie_index,
+                           {**bt2_params, 'sort': params}, bowtie2_sort,
+                           sample, code=code, nthreads=nthreads)
+        sample.files[code] = sam_files
+    else:
+        # Align with bowtie2.
+        align_files = cached(cache, 'bowtie2', reads + bowtie_index, bt2_params,
+                             bowtie2, sample, code=code, nthreads=nthreads)
+        sample.files[code] = align_files
+        sample.save()
+
+        # Sort with samtools.
+        sam_files = cached(cache, 'samtools_sort', [align_files['alignments']],
+                           params, samtools_sort, sample, code=code,
+                           nthreads=nthreads)
+        sample.files[code] = {**sample.files[code], **sam_files}
+
+    # Index with samtools.
+    sorted_path = sam_files['sortedAlignments']
+    index_files = cached(cache, 'samtools_index', [sorted_path], params,
+                         samtools_index, sample, code=code, nthreads=nthreads)
+    sample.files[code] = {**sample.files[code], **index_files}
     sample.save()
 
-    # Sort and index with samtools.
-    sam_files = samtools_sort(sample, code=code, nthreads=nthreads)
-    sample.files[code] = {**sample.files[code], **sam_files}
-    sample.save()
-    samtools_index(sample, code=code, nthreads=nthreads)
-
-    # Call RSeQC scripts.
-    distribution_files = read_distribution(sample, code=code)
-    coverage_files = geneBody_coverage(sample, code=code)
-    tin_files = tin(sample, code=code)
-    fastqc_files = fastqc(sample, code=code)
+    # Call RSeQC scripts and FastQC.
+    # These only read the sorted alignments, so they are run concurrently,
+    # one thread each.
+    steps = [(read_distribution, 'versionRseqc'),
+             (geneBody_coverage, 'versionRseqc'),
+             (tin, 'versionRseqc'),
+             (fastqc, 'versionFastqc')]
+    with ThreadPoolExecutor(max_workers=min(len(steps), nthreads)) as executor:
+        futures = []
+        for step, version in steps:
+            name = step.__name__
+            inputs = [sorted_path, bed_path]
+            params = {'version': config.get(version)}
+            futures.append(executor.submit(cached, cache, name, inputs, params,
+                                           mp_helper, step, (sample, code),
+                                           name, sample.name))
+        results = [future.result() for future in futures]
     multiqc_files = multiqc(sample, code=code)
 
-    sample.files[code] = {**sample.files[code], **distribution_files,
-                                        **coverage_files,
-                                        **tin_files,
-                                        **fastqc_files,
-                                        **multiqc_files}
+    files = {**sample.files[code]}
+    for result in results:
+        files = {**files, **result}
+    sample.files[code] = {**files, **multiqc_files}
     sample.save()
 
     os.chdir(original_wdir)
 
+def qc_helper(objectId, code='qc', nthreads=1):
+    '''
+    Helper function to run qc on a sample in a separate process.
+    The sample is retrieved again, because Parse objects can not be pickled.
+    '''
+    Sample = Object.factory('Sample')
+    sample = Sample.Query.get(objectId=objectId)
+
+    print_with_flush('# starting qc for sample {}'.format(sample.name))
+    qc(sample, code=code, nthreads=nthreads)
+    print_with_flush('# finished qc for sample {}'.format(sample.name))
+
 def run_qc(project, code='qc', nthreads=1):
     """
     Runs read quantification with RSeQC, FastQC and MultiQC on each sample.
+    Samples are processed in parallel, with the threads split between them.
     """
     print_with_flush('# starting qc for project {}'.format(project.objectId))
     # First, make sure that environment variables are set.
@@ -242,9 +344,14 @@ def run_qc(project, code='qc', nthreads=1):
     # Get samples from project.
     samples = project.relation('samples').query()
 
-    for sample in samples:
-        print_with_flush('# starting qc for sample {}'.format(sample.name))
-        qc(sample, nthreads=nthreads)
+    # Each process changes its working directory, so samples must be run in
+    # separate processes rather than threads.
+    nprocesses, sample_threads = split_threads(nthreads, len(samples))
+    print_with_flush('# running qc on {} samples at a time with {} threads each'
+                     .format(nprocesses, sample_threads))
+    args = [(sample.objectId, code, sample_threads) for sample in samples]
+    with mp.Pool(processes=nprocesses) as pool:
+        pool.starmap(qc_helper, args)
 
     # Run multiqc for the entire project.
     args = ['multiqc', project.paths[code]]
@@ -252,7 +359,7 @@ def run_qc(project, code='qc', nthreads=1):
     args += ['--ignore', 'qc_out.txt']
     args += ['-o', project.paths[code]]
     args += ['-f']
-    run_sys(args, prefix=sample.name)
+    run_sys(args, prefix=project.objectId)
 
     # Archive.
     archive_path = archive(project, code)
@@ -278,8 +385,9 @@ if __name__ == '__main__':
         scope.user = {'id': objectId}
 
         # Get number of threads.
+        # The worker sets THREADS to the number of cpus given to this job.
         config = Config.get()
-        nthreads = config['threads']
+        nthreads = int(os.getenv('THREADS', config['threads']))
 
         code = args.code
 
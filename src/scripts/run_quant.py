@@ -4,8 +4,10 @@ sentry_sdk.init(os.getenv('SENTRY_QUANT_DSN', ''), environment=os.getenv('ENVIRO
 from sentry_sdk import configure_scope
 
 import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from utilities import run_sys, print_with_flush, mp_helper, \
-                      archive, archive_project
+                      archive, archive_project, split_threads, \
+                      StepCache, cached, fingerprint
 
 PARSE_HOSTNAME = os.getenv('PARSE_HOSTNAME', 'http://parse-server:1337/parse')
 PARSE_APP_ID = os.getenv('PARSE_APP_ID', 'alaska')
@@ -48,19 +50,88 @@ def kallisto(sample, nbootstraps, nthreads=1):
 
     run_sys(args, prefix=sample.name)
 
+    return {'abundance': os.path.join(quant_path, 'abundance.tsv'),
+            'abundanceH5': os.path.join(quant_path, 'abundance.h5'),
+            'runInfo': os.path.join(quant_path, 'run_info.json')}
+
+def quant_step(sample, nbootstraps, code='quant', version=None):
+    '''
+    Returns the step cache, inputs and parameters of the kallisto step of
+    a single sample.
+    '''
+    cache = StepCache(sample.paths[code])
+    reads = [(read.path, getattr(read, 'md5Checksum', None))
+             for read in sample.relation('reads').query()]
+    inputs = reads + [sample.reference.paths['kallistoIndex']]
+    params = {'version': version,
+              'nbootstraps': nbootstraps,
+              'readType': sample.readType,
+              'readPairs': getattr(sample, 'readPairs', None),
+              'readLength': getattr(sample, 'readLength', None),
+              'readStd': getattr(sample, 'readStd', None)}
+
+    return cache, inputs, params
+
+def is_quantified(sample, nbootstraps, code='quant', version=None):
+    '''
+    Returns True if the kallisto step of the sample is up to date.
+    '''
+    cache, inputs, params = quant_step(sample, nbootstraps, code, version)
+    return cache.get('kallisto', fingerprint(inputs, params)) is not None
+
+def quant(sample, nbootstraps, code='quant', nthreads=1, version=None):
+    '''
+    Run kallisto on a single sample, unless its inputs, version and
+    arguments did not change since the last run.
+    '''
+    cache, inputs, params = quant_step(sample, nbootstraps, code, version)
+    files = cached(cache, 'kallisto', inputs, params, kallisto, sample,
+                   nbootstraps, nthreads=nthreads)
+    sample.files[code] = files
+    sample.save()
+
+def load_index(idx_path, chunk_size=16 * 1024 * 1024):
+    """
+    Loads the given index into the page cache, so that parallel kallisto runs
+    share a single read of the index from disk.
+    """
+    print_with_flush('# loading index {}'.format(idx_path))
+    with open(idx_path, 'rb') as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while f.read(chunk_size):
+            pass
 
 def run_kallisto(project, nbootstraps, code='quant', nthreads=1):
     """
     Runs read quantification with Kallisto.
     Assumes that the indices are in the folder /organisms
+    Samples are quantified in parallel, with the threads split between them.
     """
     print_with_flush('# starting qc for project {}'.format(project.objectId))
     # Get samples from project.
     samples = project.relation('samples').query()
 
-    for sample in samples:
-        print_with_flush('# starting kallisto on sample {}'.format(sample.name))
-        kallisto(sample, nbootstraps, nthreads=nthreads)
+    version = Config.get().get('versionKallisto')
+
+    # Only load the indices that will actually be used, as they are large.
+    pending = [sample for sample in samples
+               if not is_quantified(sample, nbootstraps, code, version)]
+    for idx_path in set(sample.reference.paths['kallistoIndex'] for sample in pending):
+        load_index(idx_path)
+
+    # kallisto runs as a separate process, so threads are enough.
+    nworkers, sample_threads = split_threads(nthreads, len(samples))
+    print_with_flush('# running kallisto on {} samples at a time with {} threads each'
+                     .format(nworkers, sample_threads))
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        futures = [executor.submit(mp_helper, quant,
+                                   (sample, nbootstraps, code, sample_threads,
+                                    version),
+                                   'kallisto', sample.name)
+                   for sample in samples]
+        for future in futures:
+            future.result()
 
     # Archive.
     archive_path = archive(project, code)
@@ -86,8 +157,9 @@ if __name__ == '__main__':
         scope.user = {'id': objectId}
 
         # Get number of threads.
+        # The worker sets THREADS to the number of cpus given to this job.
         config = Config.get()
-        nthreads = config['threads']
+        nthreads = int(os.getenv('THREADS', config['threads']))
         nbootstraps = config['kallistoBootstraps']
 
         code = args.code
@@ -0,0 +1,211 @@
+"""
+Tests of resumable GEO uploads against a local FTP server.
+Run with pytest from this directory. Requires pyftpdlib.
+"""
+import os
+import time
+import ftplib
+import threading
+
+import pytest
+
+pytest.importorskip('parse_rest')
+pyftpdlib = pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+import upload
+from upload import Uploader
+
+USERNAME = 'geo'
+PASSWORD = 'secret'
+DIRECTORY = 'uploads'
+
+@pytest.fixture
+def server(tmp_path):
+    """
+    Serves tmp_path over FTP on a free local port.
+    Yields the port and the remote upload directory.
+    """
+    root = tmp_path / 'ftp'
+    (root / DIRECTORY).mkdir(parents=True)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USERNAME, PASSWORD, str(root), perm='elradfmwMT')
+    handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+    ftpd = FTPServer(('127.0.0.1', 0), handler)
+    port = ftpd.socket.getsockname()[1]
+
+    t = threading.Thread(target=ftpd.serve_forever, kwargs={'timeout': 0.1})
+    t.daemon = True
+    t.start()
+    try:
+        yield port, root / DIRECTORY
+    finally:
+        ftpd.close_all()
+        t.join()
+
+def make_ftp(port, commands=None, interrupt=None):
+    """
+    Returns an FTP client class that connects to the given port, records
+    the transfer commands it sends and interrupts the first transfer after
+    the given number of bytes.
+    """
+    state = {'interrupt': interrupt}
+
+    class InterruptedSocket:
+        def __init__(self, sock, limit):
+            self.sock = sock
+            self.limit = limit
+
+        def sendall(self, data):
+            if len(data) >= self.limit:
+                self.sock.sendall(data[:self.limit])
+                self.sock.close()
+                raise ConnectionResetError('interrupted')
+            self.sock.sendall(data)
+            self.limit -= len(data)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.sock.close()
+
+    class FTP(ftplib.FTP):
+        def connect(self, host='', port_=0, timeout=-999, source_address=None):
+            return super().connect('127.0.0.1', port, timeout=timeout)
+
+        def transfercmd(self, cmd, rest=None):
+            if commands is not None:
+                commands.append(cmd.split()[0])
+            sock = super().transfercmd(cmd, rest)
+            if state['interrupt'] is not None:
+                sock = InterruptedSocket(sock, state['interrupt'])
+                state['interrupt'] = None
+            return sock
+
+    return FTP
+
+def make_uploader(ftp, **kwargs):
+    kwargs.setdefault('block_size', 1024)
+    kwargs.setdefault('backoff', 0)
+    return Uploader('localhost', USERNAME, PASSWORD, DIRECTORY, ftp=ftp,
+                    timeout=10, **kwargs)
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+def test_resume(server, tmp_path):
+    port, remote = server
+    data = os.urandom(64 * 1024)
+    local = write(tmp_path / 'archive', data)
+    write(remote / 'archive', data[:20000])
+
+    commands = []
+    checkpoints = []
+    uploader = make_uploader(make_ftp(port, commands))
+    size = uploader.upload(lambda: open(local, 'rb'), 'archive', total=len(data),
+                           resume=20000, checkpoint=checkpoints.append)
+
+    assert size == len(data)
+    assert (remote / 'archive').read_bytes() == data
+    assert commands == ['APPE']
+    assert checkpoints == [20000, len(data)]
+
+def test_remote_file_not_recorded_is_overwritten(server, tmp_path):
+    port, remote = server
+    data = os.urandom(16 * 1024)
+    local = write(tmp_path / 'archive', data)
+    write(remote / 'archive', os.urandom(4096))
+
+    commands = []
+    uploader = make_uploader(make_ftp(port, commands))
+    uploader.upload(lambda: open(local, 'rb'), 'archive', total=len(data))
+
+    assert (remote / 'archive').read_bytes() == data
+    assert commands == ['STOR']
+
+def test_throttle(server, tmp_path):
+    port, remote = server
+    data = os.urandom(32 * 1024)
+    local = write(tmp_path / 'archive', data)
+
+    uploader = make_uploader(make_ftp(port), rate=64 * 1024)
+    start = time.time()
+    uploader.upload(lambda: open(local, 'rb'), 'archive', total=len(data))
+
+    # 32 KiB at 64 KiB/s takes at least half a second.
+    assert time.time() - start >= 0.45
+    assert (remote / 'archive').read_bytes() == data
+
+def test_retry_resumes_interrupted_transfer(server, tmp_path):
+    port, remote = server
+    data = os.urandom(64 * 1024)
+    local = write(tmp_path / 'archive', data)
+
+    commands = []
+    uploader = make_uploader(make_ftp(port, commands, interrupt=10000), retries=1)
+    size = uploader.upload(lambda: open(local, 'rb'), 'archive', total=len(data))
+
+    assert size == len(data)
+    assert (remote / 'archive').read_bytes() == data
+    assert commands == ['STOR', 'APPE']
+
+def test_retry_gives_up(server, tmp_path):
+    port, remote = server
+    local = write(tmp_path / 'archive', os.urandom(1024))
+
+    class Unreachable(ftplib.FTP):
+        def connect(self, *args, **kwargs):
+            raise ConnectionRefusedError('unreachable')
+
+    uploader = make_uploader(Unreachable, retries=2)
+    with pytest.raises(ConnectionRefusedError):
+        uploader.upload(lambda: open(local, 'rb'), 'archive', total=1024)
+
+class Project:
+    """
+    Stand-in for a Parse project that records the fields of each PUT.
+    """
+    puts = []
+
+    def __init__(self, archive, state=None):
+        self.objectId = 'project'
+        self._absolute_url = '/classes/Project/project'
+        self.files = {'geo': archive}
+        self.uploadState = state
+
+    @classmethod
+    def PUT(cls, url, batch=False, **fields):
+        cls.puts.append(fields)
+
+def test_upload_saves_only_progress_and_state(server, tmp_path, monkeypatch):
+    port, remote = server
+    data = os.urandom(64 * 1024)
+    local = write(tmp_path / 'archive', data)
+    monkeypatch.setattr(upload.Config, 'get', classmethod(
+        lambda cls: {'geoDir': DIRECTORY, 'geoRetries': 0}))
+
+    # The state recorded by an interrupted upload is used to resume it.
+    Project.puts = []
+    project = Project(local)
+    with pytest.raises(Exception):
+        upload.upload(project, 'localhost', USERNAME, PASSWORD, 'archive',
+                      ftp=make_ftp(port, interrupt=30000))
+    assert project.uploadState['offset'] == 0
+
+    project = Project(local, state=project.uploadState)
+    commands = []
+    upload.upload(project, 'localhost', USERNAME, PASSWORD, 'archive',
+                  ftp=make_ftp(port, commands))
+
+    assert (remote / 'archive').read_bytes() == data
+    assert commands == ['APPE']
+    assert project.uploadState['offset'] == len(data)
+    assert project.uploadProgress == {'sent': len(data), 'total': len(data)}
+    assert all(set(fields) <= {'uploadProgress', 'uploadState'}
+               for fields in Project.puts)
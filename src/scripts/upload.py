@@ -1,5 +1,9 @@
 import os
+import json
+import time
 import ftplib
+import hashlib
+from threading import Thread
 
 PARSE_HOSTNAME = os.getenv('PARSE_HOSTNAME', 'http://parse-server:1337/parse')
 PARSE_APP_ID = os.getenv('PARSE_APP_ID', 'alaska')
@@ -19,27 +23,352 @@ register(PARSE_APP_ID, '', master_key=PARSE_MASTER_KEY)
 # Setup for parse_rest
 os.environ["PARSE_API_ROOT"] = PARSE_HOSTNAME
 
-def upload(project, host, username, password, fname):
+from compile import write_soft, stream_archive, archive_settings
+
+class UploadMismatch(Exception):
+    """
+    Raised when the remote file turns out not to be a part of the file
+    that is being uploaded.
+    """
+    pass
+
+def archive_identity(paths, params={}):
+    """
+    Identifies the contents of an upload by the size and modification time
+    of every file it is made of, and any parameters that change its bytes
+    (i.e. the compression level of a streamed archive).
+    Modification times are always included, because they are stored in the
+    tar headers.
+
+    Arguments:
+    paths  -- (list) of paths. Directories are expanded to all files in them.
+    params -- (dict) of parameters
+
+    Returns: (str) identity
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            walk = [os.path.join(root, file) for root, dirs, names in os.walk(path)
+                    for file in names]
+        else:
+            walk = [path]
+
+        for file in sorted(walk):
+            stat = os.stat(file)
+            files.append([file, stat.st_size, stat.st_mtime_ns])
+
+    data = json.dumps({'files': files, 'params': params}, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class ArchiveStream:
+    """
+    Readable binary stream of the GEO submission archive. The archive is
+    written into a pipe by a separate thread while it is being read, so it
+    is never written to disk.
+    """
+    def __init__(self, project, supplementary):
+        r, w = os.pipe()
+        self.file = open(r, 'rb')
+        self.error = None
+        self.thread = Thread(target=self._write,
+                             args=(project, supplementary, open(w, 'wb')),
+                             daemon=True)
+        self.thread.start()
+
+    def _write(self, project, supplementary, fileobj):
+        try:
+            stream_archive(project, supplementary, fileobj)
+        except Exception as e:
+            self.error = e
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+
+        # Make sure a failed archive is not mistaken for a complete one.
+        if not data:
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+        return data
+
+    def close(self):
+        # Closing the pipe also stops the writer, if it is still running.
+        self.file.close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Uploader:
+    """
+    Uploads a file over FTP. Each attempt resumes from the size of the
+    remote file by appending to it (APPE), so a failed upload does not start
+    over. Failed attempts are retried with exponential backoff.
+    A remote file that already existed before the upload is only resumed if
+    the caller knows it is a part of the same file (see upload()).
+
+    Arguments:
+    host              -- (str) FTP host
+    username          -- (str) FTP username
+    password          -- (str) FTP password
+    directory         -- (str) remote directory to upload to
+    block_size        -- (int) number of bytes sent at a time
+    rate              -- (int) maximum upload rate in bytes per second,
+                         or None for no limit
+    retries           -- (int) number of consecutive failed attempts before
+                         giving up. Attempts that made progress do not count.
+    backoff           -- (float) seconds to wait after the first failed attempt
+    max_backoff       -- (float) maximum seconds to wait between attempts
+    progress          -- (function) called with the number of bytes uploaded
+                         and the total (or None if unknown)
+    progress_interval -- (float) minimum seconds between progress calls
+    ftp               -- (class) FTP client class, which can be replaced
+                         with a stand-in for testing
+    """
+    def __init__(self, host, username, password, directory,
+                 block_size=1024 * 1024, rate=None, retries=5, backoff=1,
+                 max_backoff=300, progress=None, progress_interval=30,
+                 ftp=ftplib.FTP, timeout=300):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.directory = directory
+        self.block_size = block_size
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.ftp = ftp
+        self.timeout = timeout
+        self.last_progress = 0
+
+    def connect(self):
+        conn = self.ftp()
+        conn.connect(self.host, timeout=self.timeout)
+        conn.login(self.username, self.password)
+        conn.cwd(self.directory)
+        conn.voidcmd('TYPE I')
+        return conn
+
+    def remote_size(self, conn, fname):
+        """
+        Returns the size of the remote file, or 0 if it does not exist.
+        """
+        try:
+            return conn.size(fname) or 0
+        except ftplib.error_perm:
+            return 0
+
+    def report(self, sent, total, force=False):
+        now = time.time()
+        if self.progress is not None and \
+           (force or now - self.last_progress >= self.progress_interval):
+            self.last_progress = now
+            self.progress(sent, total)
+
+    def skip(self, f, offset):
+        """
+        Moves the given file object to the given offset. Streams that can
+        not seek are read up to the offset.
+        """
+        if getattr(f, 'seekable', lambda: False)():
+            if f.seek(0, os.SEEK_END) < offset:
+                raise UploadMismatch('remote file is larger than the upload')
+            f.seek(offset)
+            return
+
+        while offset > 0:
+            data = f.read(min(offset, self.block_size))
+            if not data:
+                raise UploadMismatch('remote file is larger than the upload')
+            offset -= len(data)
+
+    def send(self, conn, f, fname, offset, total):
+        """
+        Sends the rest of the file object, starting from the given offset.
+        Returns the number of bytes sent.
+        """
+        self.skip(f, offset)
+        cmd = '{} {}'.format('APPE' if offset > 0 else 'STOR', fname)
+
+        sent = 0
+        start = time.time()
+        with conn.transfercmd(cmd) as sock:
+            while True:
+                data = f.read(self.block_size)
+                if not data:
+                    break
+                sock.sendall(data)
+                sent += len(data)
+
+                # Throttle by sleeping until the average rate is at most the
+                # maximum rate.
+                if self.rate:
+                    wait = sent / self.rate - (time.time() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+
+                self.report(offset + sent, total)
+        conn.voidresp()
+
+        return sent
+
+    def upload(self, open_file, fname, total=None, resume=None,
+               checkpoint=None):
+        """
+        Uploads the file to the remote directory.
+
+        Arguments:
+        open_file  -- (function) that opens the file to upload as a binary
+                      file object. It is called again for each attempt.
+        fname      -- (str) remote file name
+        total      -- (int) size of the file, or None if unknown (i.e. streams).
+                      The size of a stream is counted while it is sent.
+        resume     -- (int) size of the remote file that an earlier upload of
+                      the same file recorded with checkpoint, or None. An
+                      existing remote file is only resumed if it is at least
+                      this large; otherwise it is overwritten from the start.
+        checkpoint -- (function) called with the size of the remote file
+                      whenever it is known to be a part of this file
+
+        Returns: (int) size of the remote file
+        """
+        failures = 0
+        resumed = None
+        while True:
+            try:
+                with self.connect() as conn:
+                    offset = self.remote_size(conn, fname)
+
+                    # Attempts that uploaded something are not counted as
+                    # failures.
+                    if resumed is not None and offset > resumed:
+                        failures = 0
+                    resumed = offset
+
+                    # The remote file is not known to be a part of this file.
+                    if resume is None or offset < resume or \
+                       (total is not None and offset > total):
+                        offset = 0
+
+                    # From here on, the remote file is a part of this file.
+                    resume = offset
+                    if checkpoint is not None:
+                        checkpoint(offset)
+
+                    expected = total
+                    if total is None or offset < total:
+                        with open_file() as f:
+                            sent = self.send(conn, f, fname, offset, total)
+                        if total is None:
+                            expected = offset + sent
+
+                    size = self.remote_size(conn, fname)
+                    if size != expected:
+                        raise UploadMismatch('remote file has size {}, expected {}'
+                                             .format(size, expected))
+
+                if checkpoint is not None:
+                    checkpoint(size)
+                self.report(size, total, force=True)
+                return size
+            except ftplib.error_perm:
+                # Permanent errors, such as a wrong password, will not be
+                # fixed by retrying.
+                raise
+            except (ftplib.Error, OSError, EOFError, UploadMismatch) as e:
+                failures += 1
+                if failures > self.retries:
+                    raise
+
+                # Start over if the remote file does not match.
+                if isinstance(e, UploadMismatch):
+                    resume = None
+
+                delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+                print('upload failed ({}), retrying in {}s'.format(e, delay), flush=True)
+                time.sleep(delay)
+
+def upload(project, host, username, password, fname, ftp=ftplib.FTP,
+           report=None):
+    """
+    Uploads the GEO submission archive of the project. The identity of the
+    archive and the confirmed size of the remote file are kept in the
+    project's uploadState, so that an interrupted upload is only resumed
+    if it was uploading the same archive to the same place.
+    report is also called with the progress of the upload, if given.
+    Only these two fields are saved, because the rest of the project object
+    is stale, and saving it would revert fields that are changed meanwhile.
+    """
     print('uploading project {}'.format(project.objectId))
-    archive_path = project.files['geo']
-    geo_dir = Config.get()['geoDir']
+    archive_path = project.files.get('geo')
+    config = Config.get()
+
+    def save(**fields):
+        for name, value in fields.items():
+            setattr(project, name, value)
+        project.__class__.PUT(project._absolute_url, batch=False, **fields)
+
+    def progress(sent, total):
+        save(uploadProgress={'sent': sent, 'total': total})
+        if report is not None:
+            report(project.uploadProgress)
+
+    uploader = Uploader(host, username, password, config['geoDir'],
+                        block_size=config.get('geoBlockSize', 1024 * 1024),
+                        rate=config.get('geoRate'),
+                        retries=config.get('geoRetries', 5),
+                        progress=progress,
+                        ftp=ftp)
 
-    # Open a new FTP connection.
     try:
-        with ftplib.FTP(host, username, password) as conn:
-            conn.cwd(geo_dir)
+        params = {'host': host, 'directory': config['geoDir'], 'fname': fname}
+
+        # The archive is not written to disk when compiling in streaming
+        # mode, so it is written again for each attempt. The stream is only
+        # identical if none of its files changed, which is checked with
+        # their identity.
+        if archive_path is None:
+            soft_path, supplementary = write_soft(project)
+            params['level'] = archive_settings()[0]
+            params['arcnames'] = list(supplementary)
+            identity = archive_identity(list(supplementary.values()), params)
+            open_file = lambda: ArchiveStream(project, supplementary)
+            total = None
+        else:
+            identity = archive_identity([archive_path], params)
+            open_file = lambda: open(archive_path, 'rb')
+            total = os.path.getsize(archive_path)
+
+        state = getattr(project, 'uploadState', None) or {}
+        resume = state.get('offset') if state.get('identity') == identity else None
 
-            with open(archive_path, 'rb') as f:
-                conn.storbinary('STOR {}'.format(fname), f)
+        def checkpoint(offset):
+            save(uploadState={'identity': identity, 'offset': offset})
+
+        uploader.upload(open_file, fname, total=total, resume=resume,
+                        checkpoint=checkpoint)
     except Exception as e:
-        raise Exception('error occured while uploading {}'.format(project.objectId))
+        raise Exception('error occured while uploading {}: {}'
+                        .format(project.objectId, e)) from e
 
-def run_upload(objectId, host, username, password, geo_username):
+def run_upload(objectId, host, username, password, geo_username, progress=None):
+    """
+    Uploads the project with the given objectId. progress may be a queue
+    that the progress of the upload is put into.
+    """
     # Get project with specified objectId.
     Project = Object.factory('Project')
     project = Project.Query.get(objectId=objectId)
 
-    upload(project, host, username, password, '{}_files.tar.gz'.format(geo_username))
+    upload(project, host, username, password, '{}_files.tar.gz'.format(geo_username),
+           report=progress.put if progress is not None else None)
 
 if __name__ == '__main__':
     import argparse
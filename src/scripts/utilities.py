@@ -1,38 +1,417 @@
+import io
 import os
 import time
+import glob
+import gzip
+import json
+import hashlib
+import selectors
 import tarfile
 import sys
 import datetime as dt
 import subprocess as sp
+from threading import Lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-def archive(project, code):
+# Compression level of archives. Level 0 writes uncompressed tar files,
+# which is faster for data that is already compressed (i.e. BAM files).
+# The worker sets these environment variables for each job.
+ARCHIVE_LEVEL = int(os.getenv('ARCHIVE_LEVEL', 6))
+ARCHIVE_THREADS = int(os.getenv('THREADS', 1))
+
+class ParallelGzipWriter:
+    """
+    Write-only file object that compresses blocks of data in parallel.
+    Each block is written as a separate gzip member. A concatenation of
+    gzip members is itself a valid gzip file, so the output can be read by
+    any gzip or tar implementation.
+    """
+    def __init__(self, path, level=ARCHIVE_LEVEL, nthreads=ARCHIVE_THREADS,
+                 block_size=4 * 1024 * 1024):
+        # path may also be an open binary file object (i.e. a pipe), which
+        # is then closed along with this writer.
+        self.file = open(path, 'wb') if isinstance(path, str) else path
+        self.level = level
+        self.nthreads = max(1, nthreads)
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.position = 0
+        self.executor = ThreadPoolExecutor(max_workers=self.nthreads)
+
+    @staticmethod
+    def _compress(block, level):
+        # A fixed timestamp makes the output identical for identical input.
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+            f.write(block)
+        return buf.getvalue()
+
+    def _submit(self, block):
+        # zlib releases the GIL, so threads compress in parallel.
+        self.pending.append(self.executor.submit(self._compress, block, self.level))
+
+        # Limit the number of blocks held in memory.
+        while len(self.pending) > 2 * self.nthreads:
+            self.file.write(self.pending.popleft().result())
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+        return len(data)
+
+    def set_level(self, level):
+        """
+        Changes the compression level of the data written from now on.
+        """
+        if level != self.level and self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.level = level
+
+    def flush(self):
+        """
+        Ends the current gzip member and writes all compressed data.
+        """
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+
+    def write_raw(self, data):
+        """
+        Writes already compressed data (i.e. a whole gzip member).
+        """
+        self.flush()
+        self.file.write(data)
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+        self.file.close()
+
+def tar_trailer(level=ARCHIVE_LEVEL):
+    """
+    Returns the end-of-archive marker of a tar archive with the given
+    compression level. For compressed archives, this is a separate gzip
+    member with a fixed timestamp, so that it is always identical.
+    """
+    eof = b'\0' * (2 * tarfile.BLOCKSIZE)
+    if level == 0:
+        return eof
+
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(eof)
+    return buf.getvalue()
+
+def tar_path(archive_path, level=ARCHIVE_LEVEL):
+    """
+    Returns the path of an archive with the given compression level.
+    Uncompressed archives do not have the .gz extension.
+    """
+    if level == 0 and archive_path.endswith('.gz'):
+        return archive_path[:-len('.gz')]
+    return archive_path
+
+def open_tar(archive_path, level=ARCHIVE_LEVEL, nthreads=ARCHIVE_THREADS):
+    """
+    Opens a file object to write an archive with the given compression level.
+    archive_path may also be an open binary file object.
+    """
+    if level == 0:
+        return open(archive_path, 'wb') if isinstance(archive_path, str) else archive_path
+    return ParallelGzipWriter(archive_path, level=level, nthreads=nthreads)
+
+def is_compressed(path):
+    """
+    Returns whether the given file is already gzip compressed. This includes
+    BAM files, which are blocked gzip files.
+    """
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+def write_tar_to(fileobj, items, level=ARCHIVE_LEVEL):
+    """
+    Writes the given files and directories into a tar archive written to the
+    given file object, which is either a plain binary file (level 0) or a
+    ParallelGzipWriter. The file object is not closed.
+    Files that are already compressed are stored in the gzip stream without
+    compressing them again, which is much faster and barely changes their
+    size.
+
+    Arguments:
+    fileobj -- (file object) to write the archive to
+    items   -- (list) of (path, arcname) tuples to add to the archive
+    level   -- (int) gzip compression level
+    """
+    # The archive is not closed with tar.close(), because that would
+    # write the end-of-archive marker.
+    tar = tarfile.TarFile(fileobj=fileobj, mode='w')
+    for path, arcname in items:
+        if level != 0:
+            fileobj.set_level(0 if is_compressed(path) else level)
+        tar.add(path, arcname=arcname)
+
+    if level == 0:
+        fileobj.write(tar_trailer(level))
+    else:
+        fileobj.write_raw(tar_trailer(level))
+
+def write_tar(archive_path, items, level=ARCHIVE_LEVEL, nthreads=ARCHIVE_THREADS):
+    """
+    Writes the given files and directories into a tar archive.
+    If level is 0, the archive is not compressed, and the .gz extension is
+    removed from the archive path.
+    The end-of-archive marker is written separately at the end, so that the
+    rest of the archive can be concatenated with other archives.
+
+    Arguments:
+    archive_path -- (str) path to the archive
+    items        -- (list) of (path, arcname) tuples to add to the archive
+    level        -- (int) gzip compression level
+    nthreads     -- (int) number of threads to compress with
+
+    Returns: (str) path to the written archive
+    """
+    archive_path = tar_path(archive_path, level)
+    fileobj = open_tar(archive_path, level=level, nthreads=nthreads)
+
+    try:
+        write_tar_to(fileobj, items, level=level)
+    finally:
+        fileobj.close()
+
+    return archive_path
+
+def tar_body_size(archive_path, level=ARCHIVE_LEVEL):
+    """
+    Returns the size of the given archive without its end-of-archive marker,
+    or None if the archive was not written by write_tar() with the given
+    compression level.
+    """
+    if not os.path.isfile(archive_path) or archive_path != tar_path(archive_path, level):
+        return None
+
+    trailer = tar_trailer(level)
+    size = os.path.getsize(archive_path)
+    if size < len(trailer):
+        return None
+
+    with open(archive_path, 'rb') as f:
+        f.seek(size - len(trailer))
+        if f.read() != trailer:
+            return None
+
+    return size - len(trailer)
+
+def is_newer(path, directory, exclude=('_output.txt',)):
+    """
+    Returns whether the given file is newer than everything in the directory.
+    Job output logs, which are written to while the job is running, are
+    excluded.
+    """
+    mtime = os.path.getmtime(path)
+    for root, dirs, files in os.walk(directory):
+        names = [os.path.join(root, f) for f in files if not f.endswith(exclude)]
+        for name in [root] + names:
+            if os.path.getmtime(name) > mtime:
+                return False
+
+    return True
+
+def archive(project, code, level=ARCHIVE_LEVEL, nthreads=ARCHIVE_THREADS):
     """
     Archive given source directory into output file.
     """
     archive_file = '{}_{}.tar.gz'.format(project.objectId, code)
     archive_path = os.path.join(project.paths['root'], archive_file)
     print_with_flush('# archiving {}'.format(archive_file))
-    with tarfile.open(archive_path, 'w:gz') as tar:
-        tar.add(project.paths[code], arcname=os.path.sep)
+    archive_path = write_tar(archive_path, [(project.paths[code], code)],
+                             level=level, nthreads=nthreads)
 
     return archive_path
 
-def archive_project(project, archive_file='full.tar.gz'):
+def archive_project(project, archive_file='full.tar.gz', level=ARCHIVE_LEVEL,
+                    nthreads=ARCHIVE_THREADS):
     '''
     Archives the whole project.
+    The archive is built by concatenating the archive of each analysis, which
+    is valid because a concatenation of gzip members is a valid gzip file.
+    Only the archives that are missing or out of date are regenerated.
     '''
     print_with_flush('# archiving full project')
-    archive_path = os.path.join(project.paths['root'], archive_file)
-    with tarfile.open(archive_path, 'w:gz') as tar:
+    archive_path = tar_path(os.path.join(project.paths['root'], archive_file), level)
+    tmp_path = archive_path + '.tmp'
+
+    with open(tmp_path, 'wb') as out:
         for code, item in project.paths.items():
             if code in ('read', 'root'):
                 continue
-            tar.add(project.paths[code])
+
+            if code not in project.files:
+                project.files[code] = {}
+            code_path = project.files[code].get('archive')
+
+            size = None
+            if code_path is not None:
+                size = tar_body_size(code_path, level)
+            if size is None or not is_newer(code_path, project.paths[code]):
+                code_path = archive(project, code, level=level, nthreads=nthreads)
+                project.files[code]['archive'] = code_path
+                size = tar_body_size(code_path, level)
+            else:
+                print_with_flush('# reusing archive {}'.format(code_path))
+
+            with open(code_path, 'rb') as f:
+                remaining = size
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 16 * 1024 * 1024))
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    remaining -= len(chunk)
+
+        out.write(tar_trailer(level))
+    os.replace(tmp_path, archive_path)
 
     print_with_flush('# done')
 
     return archive_path
 
+# Files smaller than this are identified by their md5 checksum, instead of
+# their modification time.
+FINGERPRINT_MD5_SIZE = 1024 * 1024
+def file_identity(path, md5=None):
+    """
+    Returns a dictionary that identifies the contents of the given file.
+    Small files are identified by size and md5 checksum. Large files are
+    identified by size and modification time, and the md5 checksum if it is
+    already known (i.e. for reads).
+    """
+    stat = os.stat(path)
+    identity = {'path': os.path.abspath(path), 'size': stat.st_size}
+
+    if md5 is None and stat.st_size <= FINGERPRINT_MD5_SIZE:
+        hash_md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            hash_md5.update(f.read())
+        md5 = hash_md5.hexdigest()
+    else:
+        identity['mtime'] = stat.st_mtime_ns
+
+    identity['md5'] = md5
+    return identity
+
+def fingerprint(inputs, params={}):
+    """
+    Calculates a fingerprint of a step from the identity of its input files
+    and its parameters (i.e. tool version and arguments).
+
+    Arguments:
+    inputs -- (list) of paths, or (path, md5) tuples if the checksum is known.
+              Directories are expanded to all the files in them.
+    params -- (dict) of parameters that affect the output
+
+    Returns: (str) fingerprint
+    """
+    identities = []
+    for item in inputs:
+        path, md5 = item if isinstance(item, tuple) else (item, None)
+
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for file in files:
+                    identities.append(file_identity(os.path.join(root, file)))
+        else:
+            identities.append(file_identity(path, md5))
+
+    identities = sorted(identities, key=lambda identity: identity['path'])
+    data = json.dumps({'inputs': identities, 'params': params}, sort_keys=True,
+                      default=str)
+
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class StepCache:
+    """
+    Records the fingerprint and output files of each step that finished
+    in the given directory, so that the step may be skipped when it is run
+    again with identical inputs.
+    """
+    def __init__(self, directory, fname='.fingerprints.json'):
+        self.path = os.path.join(directory, fname)
+        self.lock = Lock()
+        self.steps = {}
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.steps = json.load(f)
+            except ValueError:
+                self.steps = {}
+
+    def get(self, step, fp):
+        """
+        Returns the output files of the step if its fingerprint matches and
+        all of its outputs still exist. Otherwise, returns None.
+        """
+        with self.lock:
+            record = self.steps.get(step)
+
+        if record is None or record['fingerprint'] != fp:
+            return None
+
+        # Some outputs are prefixes of the actual files.
+        for path in record['files'].values():
+            if not os.path.exists(path) and not glob.glob(path + '*'):
+                return None
+
+        return record['files']
+
+    def set(self, step, fp, files):
+        with self.lock:
+            self.steps[step] = {'fingerprint': fp, 'files': files}
+
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.steps, f, indent=4)
+            os.replace(tmp_path, self.path)
+
+    def invalidate(self, step):
+        with self.lock:
+            self.steps.pop(step, None)
+
+def cached(cache, step, inputs, params, f, *args, **kwargs):
+    """
+    Runs f(*args, **kwargs) unless the step's fingerprint matches the one that
+    was recorded in the cache, in which case the recorded output files are
+    returned instead. f must return a dictionary of output files.
+    """
+    fp = fingerprint(inputs, params)
+    files = cache.get(step, fp)
+    if files is not None:
+        print_with_flush('# skipping {}, outputs are up to date'.format(step))
+        return files
+
+    # Remove the old record in case the step fails.
+    cache.invalidate(step)
+    files = f(*args, **kwargs) or {}
+
+    # Calculate the fingerprint again, in case the step modified its inputs.
+    cache.set(step, fingerprint(inputs, params), files)
+
+    return files
 
 def mp_helper(f, args, name, _id):
     """
@@ -40,10 +419,47 @@ def mp_helper(f, args, name, _id):
     """
     print_with_flush('# starting {} for {}'.format(name, _id))
 
-    f(*args)
+    result = f(*args)
 
     print_with_flush('# finished {} for {}'.format(name, _id))
 
+    return result
+
+def split_threads(nthreads, n):
+    """
+    Splits the given number of threads among n parallel tasks.
+
+    Arguments:
+    nthreads -- (int) total number of threads
+    n        -- (int) number of tasks
+
+    Returns: (tuple) of the number of tasks to run at once, and the number of
+             threads each task may use
+    """
+    nthreads = max(1, int(nthreads))
+    workers = max(1, min(n, nthreads))
+
+    return workers, max(1, nthreads // workers)
+
+def parse_cpuset(cpus):
+    """
+    Parses a docker cpuset string (i.e. '0-3,6') into a list of cpu ids.
+    Used by the worker and the webhook to split the configured cpus among
+    containers.
+    """
+    ids = []
+    for part in str(cpus).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            ids += list(range(int(first), int(last) + 1))
+        else:
+            ids.append(int(part))
+
+    return ids
+
 def get_current_datetime():
     """
     Returns current date and time as a string.
@@ -65,7 +481,120 @@ def print_with_flush(s='', **kwargs):
     print(s, **kwargs)
     sys.stdout.flush()
 
-def run_sys(cmd, prefix='', file=None):
+class OutputBuffer:
+    """
+    Retains the output of a command in chunks.
+    Optionally, only the first head lines and the last tail lines, or only the
+    lines for which keep(line) returns True, are retained.
+    """
+    def __init__(self, head=None, tail=None, keep=None):
+        self.head = head
+        self.tail = tail
+        self.keep = keep
+        self.lines = []
+        self.last = deque(maxlen=tail) if tail is not None else None
+        self.omitted = 0
+
+    def extend(self, lines):
+        if self.keep is not None:
+            lines = [line for line in lines if self.keep(line)]
+
+        # Retain everything.
+        if self.head is None and self.tail is None:
+            self.lines.extend(lines)
+            return
+
+        if self.head is not None and len(self.lines) < self.head:
+            n = self.head - len(self.lines)
+            self.lines.extend(lines[:n])
+            lines = lines[n:]
+
+        if self.last is not None:
+            self.omitted += max(0, len(self.last) + len(lines) - self.last.maxlen)
+            self.last.extend(lines)
+        else:
+            self.omitted += len(lines)
+
+    def text(self):
+        lines = list(self.lines)
+        if self.omitted:
+            lines.append('# {} lines omitted\n'.format(self.omitted))
+        if self.last is not None:
+            lines.extend(self.last)
+
+        return ''.join(lines)
+
+def echo_every(n):
+    """
+    Returns an echo filter for run_sys that lets through every n-th line, and
+    all lines that start with '#'.
+    """
+    count = [0]
+    def echo(line):
+        count[0] += 1
+        return line.startswith('#') or count[0] % n == 1 or n == 1
+
+    return echo
+
+def line_handler(prefix, output, echo=True, log=None, raw=None):
+    """
+    Returns a function that handles a chunk of complete lines of the output
+    of a command, by retaining them in the given OutputBuffer (or writing
+    them to raw), writing them to log and echoing them.
+    """
+    def handle(lines):
+        lines = [line.decode('utf-8', 'replace') + '\n' for line in lines]
+        lines = [line for line in lines if not line.isspace() and len(line) > 1]
+        if not lines:
+            return
+
+        if raw is not None:
+            raw.write(''.join(lines))
+        else:
+            output.extend(lines)
+
+        text = ''.join(prefix + ': ' + line for line in lines)
+        if log is not None:
+            log.write(text)
+
+        if callable(echo):
+            text = ''.join(prefix + ': ' + line for line in lines if echo(line))
+        if echo and text:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    return handle
+
+def relay(streams, handlers, chunk_size=64 * 1024):
+    """
+    Reads the given streams in chunks until all of them are closed, and
+    passes the complete lines of each stream to its handler.
+    """
+    with selectors.DefaultSelector() as selector:
+        partials = {}
+        for stream, handle in zip(streams, handlers):
+            fd = stream.fileno()
+            selector.register(fd, selectors.EVENT_READ, handle)
+            partials[fd] = b''
+
+        while selector.get_map():
+            for key, events in selector.select():
+                chunk = os.read(key.fd, chunk_size)
+                if not chunk:
+                    selector.unregister(key.fd)
+                    if partials[key.fd]:
+                        key.data([partials[key.fd]])
+                    continue
+
+                # Carriage returns (i.e. progress bars) also end lines.
+                lines = (partials[key.fd] + chunk).replace(b'\r\n', b'\n') \
+                                                  .replace(b'\r', b'\n') \
+                                                  .split(b'\n')
+                partials[key.fd] = lines.pop()
+                key.data(lines)
+
+def run_sys(cmd, prefix='', file=None, out=None, head=None, tail=None,
+            keep=None, echo=True, chunk_size=64 * 1024):
     """
     Runs a system command and echos all output.
     This function blocks until command execution is terminated.
@@ -73,47 +602,123 @@ def run_sys(cmd, prefix='', file=None):
     Arguments:
     prefix -- (str) to append to beginning of every output line
     file   -- (str) path to file to write output to
+    out    -- (str) path to file to write the output of the command to,
+              without any prefixes. The output is then not retained in
+              memory, and the returned output only contains the command and
+              timestamps.
+    head   -- (int) only retain this many lines from the start of the output
+    tail   -- (int) only retain this many lines from the end of the output
+    keep   -- (function) only retain lines for which this function returns True
+    echo   -- (bool or function) whether to echo output lines to stdout, or a
+              function that returns True for lines to echo (i.e. echo_every)
+
+    Returns: (str) retained output
     """
-    output = ''
     for i in range(len(cmd)):
         if not isinstance(cmd[i], str):
             cmd[i] = str(cmd[i])
-    first = '## ' + ' '.join(cmd)
-    output += first
-    print_with_flush(output)
-
-    # start process
-    with sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, bufsize=1,
-                  universal_newlines=True) as p:
-        info_start = '# process started {}\n'.format(get_current_datetime())
-        print_with_flush(info_start, end='')
-        output += info_start
-
-        if file is not None:
-            with open(file, 'a') as f:
-                f.write(output)
-
-        while p.poll() is None:
-            line = p.stdout.readline()
-            if not line.isspace() and len(line) > 1:
-                output += line
-                line = prefix + ': ' + line
-                if file is not None:
-                    with open(file, 'a') as f:
-                        f.write(line)
-                print_with_flush(line, end='')
-        p.stdout.read()
-        p.stdout.close()
+    output = OutputBuffer(head=head, tail=tail, keep=keep)
+    first = '## ' + ' '.join(cmd) + '\n'
+    info_start = '# process started {}\n'.format(get_current_datetime())
+
+    log = open(file, 'a') if file is not None else None
+    raw = open(out, 'w') if out is not None else None
+
+    handle = line_handler(prefix, output, echo, log, raw)
+
+    try:
+        print_with_flush(first + info_start, end='')
+        if log is not None:
+            log.write(first + info_start)
+
+        # start process
+        with sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT) as p:
+            relay([p.stdout], [handle], chunk_size)
+            p.wait()
 
         last = '# process finished {}\n'.format(get_current_datetime())
         print_with_flush(last, end='')
-        output += last
-        if file is not None:
-            with open(file, 'a') as f:
-                f.write(last)
-
-    time.sleep(1)
+        if log is not None:
+            log.write(last)
+    finally:
+        if log is not None:
+            log.close()
+        if raw is not None:
+            raw.close()
 
+    output = first + info_start + output.text() + last
     if p.returncode != 0:
         raise Exception('command terminated with non-zero return code!\n{}'.format(output))
     return output
+
+def run_pipe(cmds, prefix='', head=None, tail=None, keep=None, echo=True,
+             chunk_size=64 * 1024):
+    """
+    Runs a pipeline of system commands, where the stdout of each command is
+    piped to the stdin of the next, and echos the stderr of every command and
+    the output of the last. This function blocks until all commands are
+    terminated.
+
+    Arguments:
+    cmds   -- (list) of commands
+    prefix -- (str) to append to beginning of every output line
+    head   -- (int) only retain this many lines from the start of each output
+    tail   -- (int) only retain this many lines from the end of each output
+    keep   -- (function) only retain lines for which this function returns True
+    echo   -- (bool or function) whether to echo output lines to stdout, or a
+              function that returns True for lines to echo (i.e. echo_every)
+
+    Returns: (list) of the retained output of each command
+    """
+    cmds = [[str(arg) for arg in cmd] for cmd in cmds]
+    print_with_flush('## ' + ' | '.join(' '.join(cmd) for cmd in cmds))
+    print_with_flush('# process started {}'.format(get_current_datetime()))
+
+    # start processes
+    procs = []
+    streams = []
+    stdin = None
+    try:
+        for i, cmd in enumerate(cmds):
+            last = i == len(cmds) - 1
+            p = sp.Popen(cmd, stdin=stdin, stdout=sp.PIPE,
+                         stderr=sp.STDOUT if last else sp.PIPE)
+
+            # Only the next process should hold the pipe.
+            if stdin is not None:
+                stdin.close()
+            stdin = p.stdout
+
+            procs.append(p)
+            streams.append(p.stdout if last else p.stderr)
+    except BaseException:
+        # A command could not be started, so the ones that were started are
+        # killed instead of being left blocked on their pipes.
+        if stdin is not None:
+            stdin.close()
+        for stream in streams:
+            stream.close()
+        for p in procs:
+            p.kill()
+            p.wait()
+        raise
+
+    outputs = [OutputBuffer(head=head, tail=tail, keep=keep) for _ in cmds]
+    try:
+        relay(streams, [line_handler(prefix, output, echo) for output in outputs],
+              chunk_size)
+    finally:
+        for stream in streams:
+            stream.close()
+        for p in procs:
+            p.wait()
+
+    print_with_flush('# process finished {}'.format(get_current_datetime()))
+
+    outputs = [output.text() for output in outputs]
+    for cmd, p, output in zip(cmds, procs, outputs):
+        if p.returncode != 0:
+            raise Exception(('command {} terminated with non-zero return code!\n'
+                             '{}').format(cmd[0], output))
+
+    return outputs
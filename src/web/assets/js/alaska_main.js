@@ -1040,6 +1040,9 @@ function _setReadsTable() {
   var md5_id = 'md5_num';
   var md5_loading_spinner_id = 'md5_loading_spinner_num';
 
+  // The md5 checksum cell and read of each path.
+  var md5_cells = {};
+
   // Loop through each read and add rows.
   var keys = Object.keys(reads);
   for (var i = 0; i < keys.length; i++) {
@@ -1080,39 +1083,83 @@ function _setReadsTable() {
       $('#raw_reads_table').append(row);
       row.show();
 
-      // Calculate md5 sum.
-      _getMd5(path, row.children('#' + new_md5_id), read[j]);
+      md5_cells[path] = {td: row.children('#' + new_md5_id), read: read[j]};
     }
   }
+
+  // Calculate md5 sums of all reads, which are hashed in parallel.
+  _runCloudFunction('getProjectMd5', function (response) {
+    if (response.error != undefined) {
+      _showErrorModal(response.error);
+      return;
+    }
+    for (var path in md5_cells) {
+      var cell = md5_cells[path];
+      if (path in response) {
+        _waitMd5(response[path], cell.td, cell.read);
+      } else {
+        _getMd5(path, cell.td, cell.read);
+      }
+    }
+  }, {objectId: project.id});
 }
 
+// Milliseconds between polls of a running md5 checksum job.
+var md5PollInterval = 2000;
+
 function _getMd5(path, td, read) {
   _runCloudFunction('getMd5', function (response) {
-    console.log(response);
+    _waitMd5(response, td, read);
+  }, {'path': path});
+}
 
-    read.md5Checksum = response;
+function _waitMd5(job, td, read) {
+  console.log(job);
 
-    td.text(response);
-    td.children('div').hide();
+  // The request itself failed, so there is no job to poll.
+  if (job == undefined || job == null || job.id == undefined) {
+    var error = (job && job.error) || 'no checksum job';
+    _showErrorModal(`Failed to calculate md5 checksum of ${read.path}: ${error}`);
+    return;
+  }
+  if (job.status == 'error') {
+    _showErrorModal(`Failed to calculate md5 checksum of ${job.path}: ${job.error}`);
+    return;
+  }
+  if (job.status != 'done') {
+    setTimeout(function () {
+      _runCloudFunction('getMd5Status', function (response) {
+        _waitMd5(response, td, read);
+      }, {'jobId': job.id});
+    }, md5PollInterval);
+    return;
+  }
+  _setMd5(job.md5, td, read);
+}
 
-    var done = true;
-    for (var dir in reads) {
-      var group = reads[dir];
+function _setMd5(md5, td, read) {
+  read.md5Checksum = md5;
 
-      for (var i = 0; i < group.length; i++) {
-        var r = group[i];
-        if (r.md5Checksum == null || r.md5Checksum == undefined) {
-          done = false;
-        }
+  td.text(md5);
+  td.children('div').hide();
+
+  var done = true;
+  for (var dir in reads) {
+    var group = reads[dir];
+
+    for (var i = 0; i < group.length; i++) {
+      var r = group[i];
+      if (r.md5Checksum == null || r.md5Checksum == undefined) {
+        done = false;
       }
     }
-    if (done) {
-      var btn = $('#raw_reads_confirm_btn');
-      btn.css('pointer-events', 'auto');
-      btn.prop('disabled', false);
-      btn.parent().tooltip('dispose');
-    }
-  }, {'path': path});
+  }
+  if (done) {
+    var btn = $('#raw_reads_confirm_btn');
+    btn.css('pointer-events', 'auto');
+    btn.prop('disabled', false);
+    btn.parent().tooltip('dispose');
+  }
 }
 
 /**
@@ -2313,16 +2360,42 @@ function goto_progress(status) {
   // }
 }
 
+var output_cursors = {};
+var output_pending = {};
 function get_output(type, textarea, ul) {
-  _runCloudFunction('getOutput', function (response) {
+  // Skip this tick while the previous request is pending. Otherwise both
+  // would be sent with the same cursor, and the same output appended twice.
+  if (output_pending[type]) {
+    return;
+  }
+  output_pending[type] = true;
+  var offset = output_cursors[type] || 0;
+
+  Parse.Cloud.run('getOutput', {
+    objectId: jobs[type].id,
+    offset: offset
+  }).then(function (response) {
+    output_pending[type] = false;
     // console.log(response);
-    textarea.val(response.join(''));
-    textarea.scrollTop(textarea[0].scrollHeight);
+    var lines = response.result;
 
-    ul.empty();
+    // Only new output is returned, so append it unless the output
+    // was reset.
+    if (offset == 0 || response.reset) {
+      textarea.val('');
+      ul.empty();
+    }
+    output_cursors[type] = response.cursor;
 
-    for (var i = 0; i < response.length; i++) {
-      var line = response[i];
+    if (lines.length == 0) {
+      return;
+    }
+
+    textarea.val(textarea.val() + lines.join(''));
+    textarea.scrollTop(textarea[0].scrollHeight);
+
+    for (var i = 0; i < lines.length; i++) {
+      var line = lines[i];
       if (line.startsWith('##')) {
         // Allow the browser to line break any time after a slash '/' or comma ','
         line = line.replace(new RegExp('/', 'g'), '/<wbr>');
@@ -2331,7 +2404,11 @@ function get_output(type, textarea, ul) {
         ul.append($('<li>' + line.substring(3, line.length) + '</li>'));
       }
     }
-  }, {objectId: jobs[type].id})
+  }, function (error) {
+    output_pending[type] = false;
+    console.log(error);
+    _showErrorModal(error);
+  });
 }
 
 function set_output_listener_for_collapse(type, collapse, textarea, ul, badge,
@@ -0,0 +1,283 @@
+'''
+Contains a background service to calculate and cache file checksums.
+'''
+import os
+import sys
+import time
+import uuid
+import hashlib
+import sqlite3
+import traceback
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL,
+    md5 TEXT,
+    sha256 TEXT,
+    error TEXT,
+    owner TEXT,
+    updated REAL,
+    used REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_path ON jobs (path);
+CREATE INDEX IF NOT EXISTS jobs_used ON jobs (used);
+'''
+
+# Checksums calculated in the same pass over each file.
+ALGORITHMS = ('md5', 'sha256')
+
+# Jobs with these statuses are not finished.
+ACTIVE = ('queued', 'running')
+
+# Once there are more than this many jobs, the least recently used finished
+# jobs are forgotten.
+MAX_JOBS = 10000
+
+# Seconds between the heartbeats of unfinished jobs, and after which an
+# unfinished job without one was interrupted (i.e. its process died).
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 60
+
+# Seconds between writes of the progress of a job.
+PROGRESS_INTERVAL = 1
+
+def file_checksums(path, buffer_size=8 * 1024 * 1024, progress=None):
+    '''
+    Calculates the checksums of the given file with all algorithms in one
+    pass. The file is read into a single large buffer, and hashlib releases
+    the GIL while hashing it.
+
+    Arguments:
+    path        -- (str) path to the file
+    buffer_size -- (int) number of bytes read at a time
+    progress    -- (function) called with the number of bytes read so far
+
+    Returns: (dict) of algorithm to hex digest
+    '''
+    hashes = {algorithm: hashlib.new(algorithm) for algorithm in ALGORITHMS}
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    done = 0
+
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for h in hashes.values():
+                h.update(view[:n])
+            done += n
+            if progress is not None:
+                progress(done)
+
+    return {algorithm: h.hexdigest() for algorithm, h in hashes.items()}
+
+class ChecksumService:
+    '''
+    Calculates checksums of files in a bounded pool of background threads.
+    Results are cached in a SQLite file by path, size and modification time,
+    so a file is only read again if it changed. Each request returns a job,
+    whose status can be polled with its id.
+    Jobs are kept in the same file, so that they can be polled from any
+    process that serves the webhook. Each job is run by the process it was
+    submitted to, which sends heartbeats while it is unfinished.
+    The pool should be small, because hashing is limited by the throughput
+    of the disk, not the cpu.
+    '''
+    def __init__(self, path, workers=2):
+        self.path = path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(SCHEMA)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.owner = uuid.uuid4().hex
+        self.monitor = None
+
+    def _transaction(self, f):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = f(self.conn)
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return result
+
+    def _update(self, job_id, **kwargs):
+        columns = ', '.join('{} = ?'.format(column) for column in kwargs)
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET {} WHERE id = ?'.format(columns),
+                              (*kwargs.values(), job_id))
+
+    def cached(self, path, size, mtime_ns):
+        '''
+        Returns the cached checksums of the given file, or None.
+        '''
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT md5, sha256 FROM checksums WHERE path = ? AND size = ? '
+                'AND mtime_ns = ?', (path, size, mtime_ns)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(ALGORITHMS, row))
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                with self.lock:
+                    self.conn.execute(
+                        'UPDATE jobs SET updated = ? WHERE owner = ? '
+                        'AND status IN (?, ?)', (time.time(), self.owner, *ACTIVE))
+            except Exception:
+                print(traceback.format_exc(), file=sys.stderr)
+
+    def _run(self, job_id, path, size, mtime_ns):
+        self._update(job_id, status='running', updated=time.time())
+        try:
+            last = [time.time()]
+            def progress(done):
+                now = time.time()
+                if now - last[0] >= PROGRESS_INTERVAL:
+                    last[0] = now
+                    self._update(job_id, progress=done / size if size else 1,
+                                 updated=now)
+
+            result = file_checksums(path, progress=progress)
+
+            # Only cache the result if the file did not change while reading.
+            stat = os.stat(path)
+            if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+                with self.lock:
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO checksums (path, size, mtime_ns, '
+                        'md5, sha256) VALUES (?, ?, ?, ?, ?)',
+                        (path, size, mtime_ns, result['md5'], result['sha256']))
+
+            self._update(job_id, status='done', progress=1, updated=time.time(),
+                         **result)
+        except Exception as e:
+            print(traceback.format_exc(), file=sys.stderr)
+            self._update(job_id, status='error', error=str(e), updated=time.time())
+
+    def _to_dict(self, row):
+        job = {'id': row['id'], 'path': row['path'], 'status': row['status'],
+               'progress': row['progress']}
+        if row['status'] in ACTIVE and row['updated'] < time.time() - HEARTBEAT_TIMEOUT:
+            job['status'] = 'error'
+            job['error'] = 'interrupted'
+        elif row['status'] == 'done':
+            job.update({algorithm: row[algorithm] for algorithm in ALGORITHMS})
+        elif row['status'] == 'error':
+            job['error'] = row['error']
+        return job
+
+    def submit(self, path):
+        '''
+        Requests the checksums of the given file. If they are cached, the
+        returned job is already done. Requests for a file that is already
+        being hashed share the same job.
+
+        Returns: (dict) job with its id, path, status and progress, and the
+                 checksums once it is done
+        '''
+        stat = os.stat(path)
+        identity = (path, stat.st_size, stat.st_mtime_ns)
+        result = self.cached(*identity)
+
+        def f(conn):
+            now = time.time()
+            if result is None:
+                row = conn.execute(
+                    'SELECT * FROM jobs WHERE path = ? AND size = ? AND mtime_ns = ? '
+                    'AND status IN (?, ?) AND updated >= ?',
+                    (*identity, *ACTIVE, now - HEARTBEAT_TIMEOUT)).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE jobs SET used = ? WHERE id = ?',
+                                 (now, row['id']))
+                    return row, False
+
+            self._evict(conn)
+
+            job_id = uuid.uuid4().hex
+            if result is not None:
+                conn.execute(
+                    'INSERT INTO jobs (id, path, size, mtime_ns, status, progress, '
+                    'md5, sha256, updated, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, *identity, 'done', 1, result['md5'], result['sha256'],
+                     now, now))
+            else:
+                conn.execute(
+                    'INSERT INTO jobs (id, path, size, mtime_ns, status, progress, '
+                    'owner, updated, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, *identity, 'queued', 0, self.owner, now, now))
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            return row, result is None
+
+        row, new = self._transaction(f)
+        if new:
+            with self.lock:
+                if self.monitor is None:
+                    self.monitor = Thread(target=self._heartbeat)
+                    self.monitor.daemon = True
+                    self.monitor.start()
+            self.executor.submit(self._run, row['id'], *identity)
+
+        return self._to_dict(row)
+
+    def _evict(self, conn):
+        '''
+        Forgets the least recently used finished jobs while there are too
+        many jobs.
+        '''
+        excess = conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] - MAX_JOBS
+        if excess < 0:
+            return
+
+        conn.execute(
+            'DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE status '
+            'NOT IN (?, ?) OR updated < ? ORDER BY used LIMIT ?)',
+            (*ACTIVE, time.time() - HEARTBEAT_TIMEOUT, excess + 1))
+
+    def submit_many(self, paths):
+        '''
+        Requests the checksums of all the given files, which are hashed in
+        parallel by the pool.
+
+        Returns: (dict) of path to job
+        '''
+        return {path: self.submit(path) for path in paths}
+
+    def status(self, job_id):
+        '''
+        Returns the job with the given id, or None.
+        '''
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET used = ? WHERE id = ?',
+                              (time.time(), job_id))
+            row = self.conn.execute('SELECT * FROM jobs WHERE id = ?',
+                                    (job_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
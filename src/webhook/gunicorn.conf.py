@@ -0,0 +1,46 @@
+"""Gunicorn configuration of the webhook.
+
+The webhook is served by several worker processes with many threads each.
+The job queue notifications, email keys, output stream slots, task queue and
+checksum jobs are shared through SQLite and lock files in the data volume
+(see shared.py, tasks.py and checksums.py), so any worker may serve any
+request. Blocking Parse, Docker and file calls release the GIL, and
+CPU-heavy tasks run in the task queue's process pool, so concurrent requests
+do not wait on each other.
+"""
+import os
+import uuid
+
+bind = '0.0.0.0:5000'
+workers = int(os.getenv('WEBHOOK_WORKERS', 4))
+worker_class = 'gthread'
+threads = int(os.getenv('WEBHOOK_THREADS', 16))
+
+# Seconds a silent worker is given before it is restarted. With gthread this
+# is only a heartbeat of the worker process, not a limit on requests. Threads
+# held by long-polls and output streams are bounded by the webhook itself
+# (QUEUE_WAIT_TIMEOUT, WEBHOOK_STREAMS and WEBHOOK_STREAM_DURATION), which
+# leaves the rest of the threads for other requests.
+timeout = int(os.getenv('WEBHOOK_TIMEOUT', 120))
+
+# Seconds in-flight requests are given to finish on SIGTERM. Each worker then
+# stops its index containers, and its tasks are resumed on the next start.
+graceful_timeout = int(os.getenv('WEBHOOK_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+capture_output = True
+
+def on_starting(server):
+    # Identifies this start of the webhook to all workers, so that tasks of
+    # earlier starts are resumed and per-start work is only done once.
+    os.environ['WEBHOOK_BOOT_ID'] = uuid.uuid4().hex
+
+def post_worker_init(worker):
+    import webhook
+    webhook.startup()
+
+def worker_exit(server, worker):
+    import webhook
+    webhook.shutdown()
@@ -0,0 +1,184 @@
+'''
+Contains state that is shared by all worker processes of the webhook.
+Gunicorn serves the webhook with several processes, so anything that must be
+seen by every request is kept in a SQLite file or in lock files instead of in
+the memory of one process.
+'''
+import os
+import time
+import uuid
+import fcntl
+import random
+import sqlite3
+from threading import Lock
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    created REAL,
+    PRIMARY KEY (kind, key)
+);
+'''
+
+def boot_id():
+    '''
+    Returns the id of the current start of the webhook. The gunicorn master
+    sets it before forking its workers, so that all of them share it.
+    '''
+    if 'WEBHOOK_BOOT_ID' not in os.environ:
+        os.environ['WEBHOOK_BOOT_ID'] = uuid.uuid4().hex
+    return os.environ['WEBHOOK_BOOT_ID']
+
+class SharedState:
+    '''
+    Counters and keyed entries in a SQLite file, shared by all processes.
+    Every method is a single transaction, so concurrent processes never see
+    or make partial updates.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        # Transactions are started explicitly with BEGIN IMMEDIATE, which
+        # takes the write lock of the file before reading.
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False,
+                                    isolation_level=None)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(SCHEMA)
+
+    def _transaction(self, f):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = f(self.conn)
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return result
+
+    def boot(self, boot):
+        '''
+        Records the start of the webhook with the given boot id. Counters are
+        reseeded randomly on a new boot, so that their observers do not see
+        values they saw before the restart.
+
+        Returns: (bool) whether this is the first process of the boot
+        '''
+        def f(conn):
+            row = conn.execute("SELECT value FROM entries WHERE kind = 'boot' "
+                               "AND key = 'id'").fetchone()
+            if row is not None and row[0] == boot:
+                return False
+
+            conn.execute('INSERT OR REPLACE INTO entries (kind, key, value, created) '
+                         "VALUES ('boot', 'id', ?, ?)", (boot, time.time()))
+            for (name,) in conn.execute('SELECT name FROM counters').fetchall():
+                conn.execute('UPDATE counters SET value = ? WHERE name = ?',
+                             (random.getrandbits(32), name))
+            return True
+
+        return self._transaction(f)
+
+    def counter(self, name):
+        '''
+        Returns the value of the given counter, which starts at a random value.
+        '''
+        def f(conn):
+            conn.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)',
+                         (name, random.getrandbits(32)))
+            return conn.execute('SELECT value FROM counters WHERE name = ?',
+                                (name,)).fetchone()[0]
+
+        return self._transaction(f)
+
+    def increment(self, name):
+        '''
+        Increments the given counter and returns its new value.
+        '''
+        def f(conn):
+            conn.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)',
+                         (name, random.getrandbits(32)))
+            conn.execute('UPDATE counters SET value = value + 1 WHERE name = ?',
+                         (name,))
+            return conn.execute('SELECT value FROM counters WHERE name = ?',
+                                (name,)).fetchone()[0]
+
+        return self._transaction(f)
+
+    def put(self, kind, key, value=''):
+        '''
+        Sets the entry of the given kind and key.
+        '''
+        def f(conn):
+            conn.execute('INSERT OR REPLACE INTO entries (kind, key, value, created) '
+                         'VALUES (?, ?, ?, ?)', (kind, key, value, time.time()))
+
+        self._transaction(f)
+
+    def contains(self, kind, key):
+        '''
+        Returns whether there is an entry of the given kind and key.
+        '''
+        with self.lock:
+            return self.conn.execute(
+                'SELECT 1 FROM entries WHERE kind = ? AND key = ?',
+                (kind, key)).fetchone() is not None
+
+    def pop(self, kind, key):
+        '''
+        Removes the entry of the given kind and key.
+
+        Returns: (str) its value, or None if there was no such entry
+        '''
+        def f(conn):
+            row = conn.execute('SELECT value FROM entries WHERE kind = ? AND key = ?',
+                               (kind, key)).fetchone()
+            if row is None:
+                return None
+            conn.execute('DELETE FROM entries WHERE kind = ? AND key = ?',
+                         (kind, key))
+            return row[0]
+
+        return self._transaction(f)
+
+class Slots:
+    '''
+    Bounds the number of holders across all processes, with one lock file
+    per slot. The lock of a slot is released by the operating system when
+    its file is closed, including when the holding process dies.
+    '''
+    def __init__(self, directory, n):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, 'slot{}.lock'.format(i))
+                      for i in range(n)]
+
+    def acquire(self):
+        '''
+        Takes a free slot without blocking.
+
+        Returns: (int) file descriptor of the slot, or None if all are taken
+        '''
+        # Start at a random slot, so that holders do not all contend for the
+        # first ones.
+        start = random.randrange(len(self.paths)) if self.paths else 0
+        for path in self.paths[start:] + self.paths[:start]:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def release(self, fd):
+        '''
+        Frees the slot of the given file descriptor.
+        '''
+        os.close(fd)
@@ -0,0 +1,456 @@
+'''
+Contains a bounded, persistent queue for long-running webhook tasks.
+'''
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import traceback
+import multiprocessing
+from queue import Empty
+from threading import Thread, Lock, Event
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress TEXT,
+    error TEXT,
+    created REAL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+CREATE TABLE IF NOT EXISTS owners (
+    id TEXT PRIMARY KEY,
+    boot TEXT,
+    heartbeat REAL
+);
+'''
+
+# Columns added to the tasks table after its first version.
+COLUMNS = {
+    # Process that is running the task.
+    'owner': 'TEXT',
+    # Process that keeps the secrets of the task in its memory.
+    'holder': 'TEXT',
+}
+
+# Tasks with these statuses are not finished.
+ACTIVE = ('queued', 'running')
+
+# Seconds between the heartbeats of each process, and after which a process
+# that sent none is considered dead.
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 60
+
+# The process pool and the manager are started from a process with many
+# threads, which must not be forked, so they are started by a fork server.
+START_METHOD = 'forkserver'
+
+class TaskExists(Exception):
+    '''
+    Raised when a task with the same kind and key is already queued or running.
+    '''
+    pass
+
+class Task:
+    '''
+    Handle to a running task, which is passed to the task function as its
+    first argument.
+    '''
+    def __init__(self, queue, id, kind, key):
+        self.queue = queue
+        self.id = id
+        self.kind = kind
+        self.key = key
+
+    def progress(self, progress):
+        '''
+        Sets the progress of the task, which can be any JSON serializable value.
+        '''
+        self.queue._update(self.id, progress=json.dumps(progress))
+
+    def run_in_process(self, f, *args, interval=1):
+        '''
+        Runs the given function in the process pool and returns its result.
+        Use this for CPU-heavy work, so that it does not hold the GIL of the
+        webhook process. The function and arguments must be picklable.
+        The function is also passed a queue as its progress keyword argument.
+        Any value put into the queue is set as the progress of the task.
+        If a process of the pool dies, the task fails and the pool is
+        replaced for the next tasks.
+        '''
+        progress = self.queue.manager().Queue()
+        pool, future = self.queue.run_in_process(f, *args, progress=progress)
+
+        done = False
+        while not done:
+            # Values put right before the function returned are still read.
+            done = future.done()
+            try:
+                while True:
+                    self.progress(progress.get(timeout=0 if done else interval))
+            except Empty:
+                pass
+
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self.queue.discard_pool(pool)
+            raise
+
+class TaskQueue:
+    '''
+    Queue of tasks of several kinds. Each kind has a function, a maximum
+    number of tasks that may run at once and a default priority. Queued tasks
+    of a kind are started in order of priority (lower first), then in the
+    order they were submitted.
+    The state of every task is kept in a SQLite file, which is shared by all
+    processes that serve the webhook. Each process claims queued tasks in a
+    transaction, so the limits hold across processes, and sends heartbeats.
+    Tasks of a process that stopped or died are queued again by the others,
+    or by the next start of the webhook.
+    Secrets (i.e. passwords) are only kept in the memory of the process that
+    the task was submitted to and are never written to the file, so tasks
+    with secrets are only run by that process, and fail if it stops.
+    The arguments of a task are removed once it is finished.
+    '''
+    def __init__(self, path, processes=1, boot=None):
+        self.path = path
+        self.lock = Lock()
+        # Transactions are started explicitly with BEGIN IMMEDIATE, which
+        # takes the write lock of the file before reading.
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(SCHEMA)
+            self._transaction(self._migrate)
+
+        self.kinds = {}
+        self.secrets = {}
+        self.owner = uuid.uuid4().hex
+        self.boot = boot
+        self.stopped = Event()
+        self.processes = processes
+        self.pool = None
+        self._manager = None
+
+    def _transaction(self, f):
+        '''
+        Calls f with the connection in a write transaction.
+        Must be called with the lock held.
+        '''
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = f(self.conn)
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        return result
+
+    def _migrate(self, conn):
+        columns = [row['name'] for row in conn.execute('PRAGMA table_info(tasks)')]
+        for column, kind in COLUMNS.items():
+            if column not in columns:
+                conn.execute('ALTER TABLE tasks ADD COLUMN {} {}'.format(column, kind))
+        conn.execute("UPDATE tasks SET args = '[]' WHERE status NOT IN (?, ?)",
+                     ACTIVE)
+
+    def register(self, kind, f, limit=1, priority=0, secrets=False):
+        '''
+        Registers a kind of task. f is called with a Task, the arguments
+        the task was submitted with and its secrets as keyword arguments.
+        Tasks of kinds that require secrets can not be resumed.
+        '''
+        self.kinds[kind] = {'f': f, 'limit': limit, 'priority': priority,
+                            'secrets': secrets}
+
+    def _update(self, id, **kwargs):
+        columns = ', '.join('{} = ?'.format(column) for column in kwargs)
+        with self.lock:
+            self.conn.execute('UPDATE tasks SET {} WHERE id = ?'.format(columns),
+                              (*kwargs.values(), id))
+
+    def _finish(self, id, **kwargs):
+        # A task that was reclaimed from this process is not finished by it.
+        columns = ', '.join('{} = ?'.format(column) for column in kwargs)
+        with self.lock:
+            self.conn.execute(
+                'UPDATE tasks SET {} WHERE id = ? AND owner = ?'.format(columns),
+                (*kwargs.values(), id, self.owner))
+
+    def _claim(self, conn):
+        '''
+        Marks queued tasks of each kind as running by this process while
+        there are free slots.
+
+        Returns: (list) of rows of the claimed tasks
+        '''
+        claimed = []
+        for kind, info in self.kinds.items():
+            running = conn.execute(
+                'SELECT COUNT(*) FROM tasks WHERE kind = ? AND status = ?',
+                (kind, 'running')).fetchone()[0]
+            if running >= info['limit']:
+                continue
+
+            # Tasks with secrets are only claimed by the process that has them.
+            rows = conn.execute(
+                'SELECT * FROM tasks WHERE kind = ? AND status = ? '
+                'AND (holder IS NULL OR holder = ?) '
+                'ORDER BY priority, created LIMIT ?',
+                (kind, 'queued', self.owner, info['limit'] - running)).fetchall()
+            for row in rows:
+                conn.execute(
+                    'UPDATE tasks SET status = ?, owner = ?, started = ? '
+                    'WHERE id = ?', ('running', self.owner, time.time(), row['id']))
+            claimed += rows
+
+        return claimed
+
+    def _dispatch(self):
+        '''
+        Starts queued tasks that this process may claim.
+        '''
+        if self.stopped.is_set():
+            return
+
+        with self.lock:
+            claimed = self._transaction(self._claim)
+
+        for row in claimed:
+            t = Thread(target=self._run,
+                       args=(row['kind'], row['id'], row['key'],
+                             json.loads(row['args'])))
+            t.daemon = True
+            t.start()
+
+    def _run(self, kind, id, key, args):
+        with self.lock:
+            secrets = self.secrets.pop(id, {})
+
+        try:
+            self.kinds[kind]['f'](Task(self, id, kind, key), *args, **secrets)
+            self._finish(id, status='done', args='[]', finished=time.time())
+        except Exception as e:
+            print('task {} ({} {}) failed'.format(id, kind, key), file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+            self._finish(id, status='failed', args='[]', error=str(e),
+                         finished=time.time())
+        finally:
+            self._dispatch()
+
+    def submit(self, kind, key, args=[], priority=None, secrets={}):
+        '''
+        Queues a new task. Only one task with the same kind and key may be
+        queued or running at once.
+
+        Arguments:
+        kind     -- (str) registered kind of task
+        key      -- (str) key of the task (i.e. the objectId it acts on)
+        args     -- (list) JSON serializable arguments to the task function
+        priority -- (int) priority of the task, or the default of the kind
+        secrets  -- (dict) keyword arguments to the task function that are
+                    only kept in memory (i.e. passwords)
+
+        Returns: (str) id of the new task
+        '''
+        if priority is None:
+            priority = self.kinds[kind]['priority']
+
+        id = uuid.uuid4().hex
+        def insert(conn):
+            row = conn.execute(
+                'SELECT id FROM tasks WHERE kind = ? AND key = ? '
+                'AND status IN (?, ?)', (kind, key, *ACTIVE)).fetchone()
+            if row is not None:
+                raise TaskExists('{} {} is already queued as task {}'
+                                 .format(kind, key, row['id']))
+
+            conn.execute(
+                'INSERT INTO tasks (id, kind, key, priority, args, status, '
+                'holder, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (id, kind, key, priority, json.dumps(args), 'queued',
+                 self.owner if secrets else None, time.time()))
+
+        with self.lock:
+            # The secrets must be in place before any process sees the task.
+            if secrets:
+                self.secrets[id] = dict(secrets)
+            try:
+                self._transaction(insert)
+            except BaseException:
+                self.secrets.pop(id, None)
+                raise
+
+        self._dispatch()
+        return id
+
+    def _reclaim(self, conn):
+        '''
+        Queues the tasks of processes that stopped or died again, or fails
+        them if they can not be run without the secrets that were lost.
+        Processes of earlier starts of the webhook are dead by definition.
+        '''
+        conn.execute('DELETE FROM owners WHERE heartbeat < ? OR boot IS NOT ?',
+                     (time.time() - HEARTBEAT_TIMEOUT, self.boot))
+        alive = 'SELECT id FROM owners'
+
+        rows = conn.execute(
+            'SELECT * FROM tasks WHERE (status = ? AND (owner IS NULL OR owner '
+            'NOT IN ({0}))) OR (status IN (?, ?) AND holder IS NOT NULL AND holder '
+            'NOT IN ({0})) ORDER BY created'.format(alive),
+            ('running', *ACTIVE)).fetchall()
+        for row in rows:
+            error = None
+            if row['kind'] not in self.kinds:
+                error = 'unknown task kind'
+            elif row['holder'] is not None or self.kinds[row['kind']]['secrets']:
+                error = 'secrets are not kept across restarts'
+
+            if error is not None:
+                conn.execute(
+                    'UPDATE tasks SET status = ?, args = ?, error = ?, '
+                    'finished = ? WHERE id = ?',
+                    ('failed', '[]', error, time.time(), row['id']))
+            else:
+                print('requeueing task {} ({} {})'.format(
+                    row['id'], row['kind'], row['key']), file=sys.stderr)
+                conn.execute('UPDATE tasks SET status = ?, owner = NULL '
+                             'WHERE id = ?', ('queued', row['id']))
+
+    def _heartbeat(self, conn):
+        conn.execute('INSERT OR REPLACE INTO owners (id, boot, heartbeat) '
+                     'VALUES (?, ?, ?)', (self.owner, self.boot, time.time()))
+
+    def _monitor(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                with self.lock:
+                    self._transaction(self._heartbeat)
+                    self._transaction(self._reclaim)
+                self._dispatch()
+            except Exception:
+                print(traceback.format_exc(), file=sys.stderr)
+
+    def resume(self):
+        '''
+        Starts running tasks in this process. Tasks that were queued or
+        running when the webhook last stopped are queued again. Must be
+        called once by every process, after all kinds are registered.
+        '''
+        with self.lock:
+            self._transaction(self._heartbeat)
+            self._transaction(self._reclaim)
+
+        t = Thread(target=self._monitor)
+        t.daemon = True
+        t.start()
+        self._dispatch()
+
+    def stop(self):
+        '''
+        Stops claiming tasks in this process. The tasks it was running are
+        queued again by the other processes, or by the next start.
+        '''
+        self.stopped.set()
+        with self.lock:
+            self.conn.execute('DELETE FROM owners WHERE id = ?', (self.owner,))
+
+    def active(self, kind, key):
+        '''
+        Returns whether a task of the given kind and key is queued or running.
+        '''
+        with self.lock:
+            return self.conn.execute(
+                'SELECT 1 FROM tasks WHERE kind = ? AND key = ? AND status IN (?, ?)',
+                (kind, key, *ACTIVE)).fetchone() is not None
+
+    def manager(self):
+        '''
+        Returns the manager of objects that are shared with the process pool.
+        '''
+        with self.lock:
+            if self._manager is None:
+                self._manager = multiprocessing.get_context(START_METHOD).Manager()
+            return self._manager
+
+    def run_in_process(self, f, *args, **kwargs):
+        '''
+        Submits the given function to the process pool. A pool that is
+        broken (i.e. one of its processes was killed) is replaced.
+
+        Returns: (tuple) of the pool and the future
+        '''
+        while True:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(
+                        max_workers=self.processes,
+                        mp_context=multiprocessing.get_context(START_METHOD))
+                pool = self.pool
+            try:
+                return pool, pool.submit(f, *args, **kwargs)
+            except BrokenProcessPool:
+                self.discard_pool(pool)
+
+    def discard_pool(self, pool):
+        '''
+        Replaces the given process pool, which is broken, with a new one
+        on the next submission.
+        '''
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False)
+
+    def _to_dict(self, row):
+        # Arguments and processes are internal, so they are not returned.
+        task = dict(row)
+        for column in ('args', *COLUMNS):
+            del task[column]
+        if task['progress'] is not None:
+            task['progress'] = json.loads(task['progress'])
+        return task
+
+    def get(self, id):
+        '''
+        Returns the task with the given id as a dictionary, or None.
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM tasks WHERE id = ?',
+                                    (id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def list(self, kind=None, status=None, limit=100):
+        '''
+        Returns the most recent tasks, optionally of the given kind and status.
+        '''
+        query = 'SELECT * FROM tasks'
+        conditions = []
+        params = []
+        if kind is not None:
+            conditions.append('kind = ?')
+            params.append(kind)
+        if status is not None:
+            conditions.append('status = ?')
+            params.append(status)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY created DESC LIMIT ?'
+        params.append(limit)
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [self._to_dict(row) for row in rows]
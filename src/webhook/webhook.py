@@ -19,13 +19,17 @@ import signal
 import string
 import docker
 import shutil
+import zlib
 import hashlib
 import traceback
 import datetime as dt
-from threading import Thread
+from threading import Thread, Condition
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
 # import docker
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, \
+                  stream_with_context
 from urllib.parse import unquote_plus
 from threading import Thread
 
@@ -47,32 +51,43 @@ from parse_rest.core import ResourceRequestBadRequest, ParseError
 register(PARSE_APP_ID, '', master_key=PARSE_MASTER_KEY)
 
 sys.path.append(Config.get()['scriptPath'])
-from compile import compile
-from upload import upload
-
-compiling = {}
-uploading = {}
-index_container = None
-def sigterm_handler(signal, frame):
-    print('SIGTERM received', file=sys.stderr, flush=True)
-    print(compiling, uploading, file=sys.stderr, flush=True)
-
-    Project = Object.factory('Project')
-
-    for objectId, t in compiling.items():
-        if t.is_alive():
-            project = Project.Query.get(objectId=objectId)
-            project.progress = 'success'
-            project.save()
-
-
-    for objectId, t in uploading.items():
-        if t.is_alive():
-            project = Project.Query.get(objectId=objectId)
-            project.progress = 'compiled'
-            project.save()
-
-    if index_container is not None:
+from compile import run_compile, query_all
+from upload import run_upload
+from catalog import open_catalog
+from tasks import TaskQueue, TaskExists
+from checksums import ChecksumService
+from shared import SharedState, Slots, boot_id
+from citation import kallisto_flags, sample_citation_info
+from utilities import parse_cpuset
+
+# The webhook is served by several processes, so state that is shared by
+# requests is kept in the data volume instead of in memory.
+state = SharedState(os.path.join(Config.get()['dataPath'], 'webhook.sqlite'))
+
+# Compile, upload and index build tasks are run by a bounded queue, which is
+# shared by all processes. Compile and index build tasks that are running
+# when a process stops are run again by another process or when the webhook
+# starts, so the project progress is not reset on SIGTERM. Uploads are not,
+# because the FTP credentials are only kept in the memory of one process.
+TASK_LIMITS = {'compile': 1, 'upload': 2, 'index': 1}
+task_limits = {**TASK_LIMITS, **Config.get().get('taskLimits', {})}
+tasks = TaskQueue(os.path.join(Config.get()['dataPath'], 'tasks.sqlite'),
+                  processes=task_limits['compile'] + task_limits['upload'],
+                  boot=boot_id())
+
+# Checksums of reads are calculated in the background and cached.
+checksums = ChecksumService(os.path.join(Config.get()['dataPath'], 'checksums.sqlite'),
+                            workers=Config.get().get('checksumWorkers', 2))
+
+index_containers = {}
+def shutdown():
+    '''
+    Stops claiming tasks and stops all index containers of this process.
+    Unfinished tasks are resumed by another process, or when the webhook
+    starts again.
+    '''
+    tasks.stop()
+    for index_container in list(index_containers.values()):
         try:
             print('sending SIGTERM to container {}'.format(index_container.name),
                   flush=True)
@@ -82,11 +97,13 @@ def sigterm_handler(signal, frame):
         finally:
             index_container.remove(force=True)
 
+def sigterm_handler(signal, frame):
+    print('SIGTERM received', file=sys.stderr, flush=True)
+    shutdown()
     sys.exit(0)
 
-
-# Handle SIGTERM gracefully.
-signal.signal(signal.SIGTERM, sigterm_handler)
+# Maximum number of objects in a single Parse batch request.
+BATCH_SIZE = 50
 
 # Actual flask application.
 app = Flask(__name__)
@@ -105,23 +122,77 @@ def status():
 def trigger_error():
     division_by_zero = 1 / 0
 
-verified = []
-verification = {}
+@app.route('/task/<task_id>', methods=['GET', 'POST'])
+def task_status(task_id):
+    task = tasks.get(task_id)
+    if task is None:
+        return jsonify({'error': 'no task {}'.format(task_id)})
+    return jsonify({'result': task})
+
+@app.route('/tasks', methods=['GET', 'POST'])
+def task_list():
+    return jsonify({'result': tasks.list(kind=request.args.get('kind'),
+                                         status=request.args.get('status'))})
+
+# Job queue notification channel.
+# The cloud code notifies whenever a job is enqueued, and the worker long-polls
+# for changes so that it does not have to poll Parse while the queue is empty.
+# The sequence number is kept in the shared state, because the notification
+# and the long-poll may be served by different processes. It is reseeded
+# randomly on every start, so that it does not repeat values the worker saw
+# before the webhook restarted. Long-polls served by the notified process
+# are woken at once, and the others within QUEUE_WAIT_INTERVAL seconds.
+queue_condition = Condition()
+
+@app.route('/queue/notify', methods=['POST'])
+def queue_notify():
+    seq = state.increment('queue')
+    with queue_condition:
+        queue_condition.notify_all()
+
+    return jsonify({'result': seq})
+
+# Long-polls hold a serving thread, so they are limited to this many seconds.
+QUEUE_WAIT_TIMEOUT = 60
+QUEUE_WAIT_INTERVAL = 0.5
+
+@app.route('/queue/wait', methods=['POST'])
+def queue_wait():
+    '''
+    Long-poll endpoint that blocks until the queue sequence number differs
+    from the one given by the caller, or until the timeout expires.
+    '''
+    seq = request.args.get('seq', default=-1, type=int)
+    timeout = min(request.args.get('timeout', default=60, type=float),
+                  QUEUE_WAIT_TIMEOUT)
+
+    deadline = time.time() + timeout
+    while True:
+        current = state.counter('queue')
+        remaining = deadline - time.time()
+        if current != seq or remaining <= 0:
+            return jsonify({'result': current})
+
+        with queue_condition:
+            queue_condition.wait(min(remaining, QUEUE_WAIT_INTERVAL))
+
+# Verification keys and verified emails are kept in the shared state, because
+# the email may be sent and verified by different processes.
 
 @app.route('/email/verified', methods=['POST'])
 def email_verified():
     data = request.get_json()
     email = data['email']
 
-    if email in verified:
+    if state.contains('verified', email):
         return jsonify({'result': True})
     return jsonify({'result': False})
 
 @app.route('/email/verify/<key>', methods=['GET', 'POST'])
 def verify_email(key):
-    if key in verification:
-        verified.append(verification[key])
-        del verification[key]
+    email = state.pop('verification', key)
+    if email is not None:
+        state.put('verified', email)
     else:
         return jsonify({'result': 'invalid verification key'})
 
@@ -142,7 +213,7 @@ def send_verification_email():
     key = ''
     for i in range(24):
         key += str(random.choice(string.digits))
-    verification[key] = to
+    state.put('verification', key, to)
 
     url = 'http://{}/webhook/email/verify/{}'.format(host, key)
 
@@ -169,9 +240,8 @@ def send_verification_email():
 
     return jsonify({'result': email_file})
 
-to_reset = set()
-resets = set()
-reset = {}
+# Password reset keys (reset), verified resets (resets) and emails whose
+# password may be reset (to_reset) are kept in the shared state.
 @app.route('/reset/notify', methods=['POST'])
 def reset_notify():
     data = request.get_json()
@@ -206,8 +276,7 @@ def reset_check():
     data = request.get_json()
     email = data['email']
 
-    if email in to_reset:
-        to_reset.remove(email)
+    if state.pop('to_reset', email) is not None:
         return jsonify({'result': True})
     return jsonify({'result': False})
 
@@ -216,17 +285,16 @@ def reset_verified():
     data = request.get_json()
     email = data['email']
 
-    if email in resets:
-        resets.remove(email)
-        to_reset.add(email)
+    if state.pop('resets', email) is not None:
+        state.put('to_reset', email)
         return jsonify({'result': True})
     return jsonify({'result': False})
 
 @app.route('/reset/verify/<key>', methods=['GET', 'POST'])
 def verify_reset(key):
-    if key in reset:
-        resets.add(reset[key])
-        del reset[key]
+    email = state.pop('reset', key)
+    if email is not None:
+        state.put('resets', email)
     else:
         return jsonify({'result': 'invalid reset key'})
 
@@ -247,7 +315,7 @@ def send_reset_email():
     key = ''
     for i in range(24):
         key += str(random.choice(string.digits))
-    reset[key] = to
+    state.put('reset', key, to)
 
     url = 'http://{}/webhook/reset/verify/{}'.format(host, key)
 
@@ -292,138 +360,172 @@ def organismNew():
     # Make the directory in case it doesn't exist.
     os.makedirs(organism_path, exist_ok=True)
 
-    organisms = Function('getOrganismsDict')()['result']
-
-    for genus in os.listdir(organism_path):
-        genus_path = os.path.join(organism_path, genus)
-        if not os.path.isdir(genus_path):
+    # Load all organisms and references at once, and index them by name.
+    Organism = Object.factory('Organism')
+    Reference = Object.factory('Reference')
+    organisms = {}
+    for organism in query_all(Organism.Query.all().order_by('createdAt')):
+        organisms[(organism.genus, organism.species)] = organism
+    versions = {}
+    for reference in query_all(Reference.Query.all().order_by('createdAt')):
+        versions[(reference.organism.objectId, reference.version)] = reference
+
+    # Update the catalog of the organisms tree. Only directories that
+    # changed since the last scan are listed again.
+    catalog = open_catalog(config)
+    catalog.refresh(organism_path, reference_dir)
+
+    new_organisms = []
+    new_references = []
+    changed_references = []
+    for found in catalog.references(organism_path, reference_dir):
+        genus = found['genus']
+        species = found['species']
+        version = found['version']
+        version_path = found['path']
+        species_path = os.path.dirname(version_path)
+        reference_path = os.path.join(version_path, reference_dir)
+
+        # Make new organism.
+        organism = organisms.get((genus, species))
+        if organism is None:
+            organism = Organism(genus=genus, species=species,
+                                path=species_path)
+            organisms[(genus, species)] = organism
+            new_organisms.append(organism)
+        elif (organism.objectId, version) in versions:
+            # Indices must be built again if their input files changed.
+            reference = versions[(organism.objectId, version)]
+            changed = catalog.changed(reference_path)
+            flags = [flag for flag, kind in [('bowtieBuilt', 'dna'),
+                                             ('kallistoBuilt', 'cdna')]
+                     if kind in changed and getattr(reference, flag, True)]
+            if flags:
+                print('{}-{}-{} changed'.format(genus, species, version),
+                      file=sys.stderr)
+                for flag in flags:
+                    setattr(reference, flag, False)
+                reference.indexBuilt = False
+                reference.ready = False
+                changed_references.append(reference)
             continue
 
-        for species in os.listdir(genus_path):
-            species_path = os.path.join(genus_path, species)
-            if not os.path.isdir(species_path):
-                continue
+        # Get reference files.
+        bed = found['files'].get('bed')
+        annotation = found['files'].get('annotation')
+        cdna = found['files'].get('cdna')
+        dna = found['files'].get('dna')
 
-            for version in os.listdir(species_path):
-                version_path = os.path.join(species_path, version)
-                reference_path = os.path.join(version_path, reference_dir)
-                if not os.path.isdir(reference_path):
-                    continue
-
-                # Make new organism.
-                Organism = Object.factory('Organism')
-                if genus not in organisms or species not in organisms[genus]:
-                    organism = Organism(genus=genus, species=species,
-                                        path=species_path)
-                    organism.save()
-
-                    if genus not in organisms:
-                        organisms[genus] = {}
-                    if species not in organisms[genus]:
-                        organisms[genus][species] = organism
-                else:
-                    # Otherwise, the organism already exists.
-                    found = Organism.Query.filter(genus=genus, species=species)
-                    assert(len(found) == 1)
-                    organism = found[0]
-
-                # Get all reference versions.
-                references = organism.relation('references').query()
-                versions = [reference.version for reference in references]
-
-                if version not in versions:
-                    # Get reference files.
-                    bed = None
-                    annotation = None
-                    cdna = None
-                    dna = None
-                    for fname in os.listdir(reference_path):
-                        path = os.path.join(reference_path, fname)
-                        if fname.endswith('.bed'):
-                            bed = path
-                        elif '_annotation' in fname:
-                            annotation = path
-                        elif '_cdna' in fname:
-                            cdna = path
-                        elif '_dna' in fname:
-                            dna = path
-
-                    if bed and annotation and cdna and dna:
-                        print('found {}-{}-{}'.format(genus, species, version),
-                              file=sys.stderr)
-
-                        index_prefix = '{}_{}_{}'.format(genus, species, version)
-                        kallisto_index_name = index_prefix + '.idx'
-                        kallisto_index_path = os.path.join(version_path,
-                                                           kallisto_dir,
-                                                           kallisto_index_name)
-                        bowtie_index_path = os.path.join(version_path,
-                                                         bowtie_dir,
-                                                         index_prefix)
-
-                        # Paths.
-                        paths = {'root': version_path,
-                                 'dna': dna,
-                                 'cdna': cdna,
-                                 'bed': bed,
-                                 'annotation': annotation,
-                                 'kallistoIndex': kallisto_index_path,
-                                 'bowtieIndex': bowtie_index_path}
-
-                        # Make new reference.
-                        Reference = Object.factory('Reference')
-                        reference = Reference(version=version,
-                                              organism=organism,
-                                              paths=paths,
-                                              indexBuilt=False,
-                                              ready=False)
-                        reference.save()
-                        organism.relation('references').add([reference])
+        if bed and annotation and cdna and dna:
+            print('found {}-{}-{}'.format(genus, species, version),
+                  file=sys.stderr)
+
+            index_prefix = '{}_{}_{}'.format(genus, species, version)
+            kallisto_index_name = index_prefix + '.idx'
+            kallisto_index_path = os.path.join(version_path,
+                                               kallisto_dir,
+                                               kallisto_index_name)
+            bowtie_index_path = os.path.join(version_path,
+                                             bowtie_dir,
+                                             index_prefix)
+
+            # Paths.
+            paths = {'root': version_path,
+                     'dna': dna,
+                     'cdna': cdna,
+                     'bed': bed,
+                     'annotation': annotation,
+                     'kallistoIndex': kallisto_index_path,
+                     'bowtieIndex': bowtie_index_path}
+
+            # The organism is set once it is saved.
+            reference = Reference(version=version,
+                                  paths=paths,
+                                  indexBuilt=False,
+                                  bowtieBuilt=False,
+                                  kallistoBuilt=False,
+                                  ready=False)
+            new_references.append((organism, reference))
+
+    catalog.close()
+
+    # Save everything in batches. Organisms must be saved first, because
+    # references point to them.
+    batcher = ParseBatcher()
+    for i in range(0, len(new_organisms), BATCH_SIZE):
+        batcher.batch_save(new_organisms[i:i+BATCH_SIZE])
+    for organism, reference in new_references:
+        reference.organism = organism
+    references = [reference for organism, reference in new_references]
+    references += changed_references
+    for i in range(0, len(references), BATCH_SIZE):
+        batcher.batch_save(references[i:i+BATCH_SIZE])
+
+    # Add all new references of each organism at once.
+    added = {}
+    for organism, reference in new_references:
+        added.setdefault(organism.objectId, (organism, []))[1].append(reference)
+    for organism, organism_references in added.values():
+        organism.relation('references').add(organism_references)
+
+    print('found {} new organisms and {} new references'.format(
+        len(new_organisms), len(new_references)), file=sys.stderr)
 
     return jsonify({'status': 'done'})
 
-indexThread = None
 @app.route('/reference/build', methods=['POST'])
 def referenceBuild():
     '''
     Method to build all non-built references new organisms.
     '''
-    global indexThread
-
-    # Get all non-ready references.
-    if indexThread is not None and indexThread.is_alive():
+    try:
+        task_id = tasks.submit('index', 'references')
+    except TaskExists:
         return jsonify({'status': 'running'})
 
-    Reference = Object.factory('Reference')
-    references = Reference.Query.filter(ready=False)
+    return jsonify({'status': 'started', 'task': task_id})
 
-    print(references, file=sys.stderr)
+def _referencesBuild(task):
+    '''
+    Function that is called by the index task.
+    Several references are built at once, each in its own container with
+    its own subset of the configured cpus. The number of concurrent
+    containers is set by the indexJobs config.
+    '''
+    # Get all non-ready references.
+    Reference = Object.factory('Reference')
+    references = query_all(Reference.Query.filter(ready=False).order_by('createdAt'))
     print('found {} unbuilt reference'.format(len(references)), file=sys.stderr)
+    if not references:
+        return
 
-    indexThread = Thread(target=_referencesBuild, args=(references,))
-    indexThread.daemon = True
-    indexThread.start()
+    config = Config.get()
+    cpus = parse_cpuset(config['cpus'])
+    n_jobs = max(1, min(config.get('indexJobs', 2), len(cpus), len(references)))
 
-    return jsonify({'status': 'started'})
+    # Split the cpus into one slice per container.
+    slices = Queue()
+    for i in range(n_jobs):
+        slices.put(cpus[i::n_jobs])
 
-def _referencesBuild(references):
-    '''
-    Function that is called by the thread.
-    '''
-    for reference in references:
+    def helper(reference):
+        cpu_slice = slices.get()
         try:
-            _referenceBuild(reference)
+            _referenceBuild(reference, cpu_slice)
         except Exception as e:
             print('error while building reference {}'.format(reference.objectId),
                   file=sys.stderr)
             print(traceback.format_exc(), file=sys.stderr)
+        finally:
+            slices.put(cpu_slice)
 
-    # Set indexThread to None.
-    indexThread = None
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(helper, references))
 
-def _referenceBuild(reference):
+def _referenceBuild(reference, cpus=None):
     '''
     Helper function that blocks until the given reference is built.
+    The container is given the cpus in the given list, or all configured cpus.
     '''
     # Make sure the index hasn't been built yet.
     if reference.ready:
@@ -437,7 +539,8 @@ def _referenceBuild(reference):
     script_path = config['scriptPath']
     script = config['indexScript']
     network = config['repoName'] + '_' + config['backendNetworkName']
-    cpus = config['cpus']
+    if cpus is None:
+        cpus = parse_cpuset(config['cpus'])
 
     # begin container variables
     cmd = 'python3 {} {}'.format(script, reference.objectId)
@@ -450,21 +553,37 @@ def _referenceBuild(reference):
         'PARSE_APP_ID': PARSE_APP_ID,
         'PARSE_MASTER_KEY': PARSE_MASTER_KEY,
         'SENTRY_DSN': os.getenv('SENTRY_INDEX_DSN', ''),
-        'ENVIRONMENT': os.getenv('ENVIRONMENT', 'default')
+        'ENVIRONMENT': os.getenv('ENVIRONMENT', 'default'),
+        'THREADS': str(len(cpus))
     }
     wdir = script_path
     name = 'index-{}'.format(reference.objectId)
 
-    print(cmd, volumes, wdir, file=sys.stderr)
+    print(cmd, volumes, wdir, cpus, file=sys.stderr)
 
     # Docker client.
     client = docker.from_env()
-    index_container = client.containers.run(index_image, cmd, detach=False, stderr=True,
-                                      auto_remove=True, volumes=volumes,
-                                      working_dir=wdir, cpuset_cpus=cpus,
-                                      network=network, environment=environment,
-                                      name=name)
-    index_container = None
+
+    # Remove the container of an earlier attempt, whose process stopped.
+    try:
+        client.containers.get(name).remove(force=True)
+    except docker.errors.NotFound:
+        pass
+
+    index_container = client.containers.run(index_image, cmd, detach=True,
+                                            volumes=volumes, working_dir=wdir,
+                                            cpuset_cpus=','.join(str(cpu) for cpu in cpus),
+                                            network=network,
+                                            environment=environment, name=name)
+    index_containers[reference.objectId] = index_container
+    try:
+        status = index_container.wait()['StatusCode']
+        if status != 0:
+            raise Exception('index container exited with {}: {}'.format(
+                status, index_container.logs(stdout=False, stderr=True)))
+    finally:
+        index_containers.pop(reference.objectId, None)
+        index_container.remove(force=True)
 
 @app.route('/project/<objectId>/initialize', methods=['POST'])
 def project_initialize(objectId):
@@ -491,20 +610,18 @@ def project_compile(objectId):
     try:
         token = request.args.get('sessionToken')
         with SessionToken(token):
-            if objectId in compiling and compiling[objectId].is_alive():
-                raise Exception('{} is already being compiled'.format(objectId))
-
             Project = Object.factory('Project')
             project = Project.Query.get(objectId=objectId)
+
             project.progress = 'compiling'
             project.save()
 
-            t = Thread(target=_project_compile, args=(project,))
-            t.daemon = True
-            compiling[objectId] = t
-            t.start()
+            try:
+                task_id = tasks.submit('compile', objectId, [objectId])
+            except TaskExists:
+                raise Exception('{} is already being compiled'.format(objectId))
 
-            return jsonify({'result':'compiling'})
+            return jsonify({'result':'compiling', 'task': task_id})
     except Exception as e:
         print(traceback.format_exc(), file=sys.stderr)
         return jsonify({'error': str(e)})
@@ -522,18 +639,20 @@ def project_upload(objectId):
 
             Project = Object.factory('Project')
             project = Project.Query.get(objectId=objectId)
+
             project.progress = 'uploading'
             project.save()
 
-            if objectId in uploading and uploading[objectId].is_alive():
+            # The FTP credentials are only kept in memory.
+            try:
+                task_id = tasks.submit('upload', objectId, [objectId, geo_username],
+                                       secrets={'host': host,
+                                                'username': username,
+                                                'password': password})
+            except TaskExists:
                 raise Exception('{} is already being uploaded'.format(objectId))
 
-            t = Thread(target=_project_upload, args=(project, host, username, password, geo_username,))
-            t.daemon = True
-            uploading[objectId] = t
-            t.start()
-
-            return jsonify({'result': 'uploading'})
+            return jsonify({'result': 'uploading', 'task': task_id})
 
     except Exception as e:
         print(traceback.format_exc(), file=sys.stderr)
@@ -577,7 +696,34 @@ def project_get(objectId, code, name):
 @app.route('/job/<objectId>/output', methods=['POST'])
 def job_output(objectId):
     try:
-        return _job_output(objectId)
+        cursor = request.args.get('offset', default=None)
+        return _job_output(objectId, cursor)
+    except Exception as e:
+        print(traceback.format_exc(), file=sys.stderr)
+        return jsonify({'error': str(e)})
+
+@app.route('/job/<objectId>/output/stream', methods=['GET'])
+def job_output_stream(objectId):
+    try:
+        # Server-sent events send the last received id on reconnection.
+        cursor = request.headers.get('Last-Event-ID', default=None)
+        if cursor is None:
+            cursor = request.args.get('offset', default=None)
+
+        # Each stream holds a serving thread, so the number of streams is
+        # bounded across all processes. Clients are asked to come back later
+        # instead of waiting.
+        slot = output_streams.acquire()
+        if slot is None:
+            return Response('too many output streams', status=503,
+                            headers={'Retry-After': str(OUTPUT_STREAM_RETRY)})
+        try:
+            response = _job_output_stream(objectId, cursor)
+        except Exception:
+            output_streams.release(slot)
+            raise
+        response.call_on_close(lambda: output_streams.release(slot))
+        return response
     except Exception as e:
         print(traceback.format_exc(), file=sys.stderr)
         return jsonify({'error': str(e)})
@@ -625,6 +771,27 @@ def read_md5():
         print(traceback.format_exc(), file=sys.stderr)
         return jsonify({'error': str(e)})
 
+@app.route('/read/md5/<job_id>', methods=['POST'])
+def read_md5_status(job_id):
+    try:
+        job = checksums.status(job_id)
+        if job is None:
+            raise Exception('no checksum job {}'.format(job_id))
+        return jsonify({'result': job})
+    except Exception as e:
+        print(traceback.format_exc(), file=sys.stderr)
+        return jsonify({'error': str(e)})
+
+@app.route('/project/<objectId>/md5', methods=['POST'])
+def project_md5(objectId):
+    try:
+        token = request.args.get('sessionToken')
+        with SessionToken(token):
+            return _project_md5(objectId)
+    except Exception as e:
+        print(traceback.format_exc(), file=sys.stderr)
+        return jsonify({'error': str(e)})
+
 @app.route('/read/delete', methods=['POST'])
 def read_delete():
     try:
@@ -759,54 +926,129 @@ def _project_delete(objectId):
 
     return jsonify({'result': 'success'})
 
-def _job_output(objectId):
+OUTPUT_CHUNK_SIZE = 1024 * 1024
+def _parse_cursor(cursor):
+    '''
+    Splits an output cursor of the form <generation>:<offset> into a tuple.
+    A plain offset has no generation.
+    '''
+    if not cursor:
+        return None, 0
+
+    generation, _, offset = str(cursor).rpartition(':')
+    return generation or None, int(offset)
+
+def _read_output(path, cursor, started=None, size=OUTPUT_CHUNK_SIZE):
+    '''
+    Reads at most size bytes of complete lines after the given cursor.
+    The worker replaces the output file with a new one whenever the job is
+    (re)started, so the cursor identifies the file by its inode and the start
+    time of the job, in addition to the byte offset. If the file changed, or
+    shrunk, it is read from the beginning.
+    Returns a tuple of the lines, the cursor to continue from and whether
+    the output was reset.
+    '''
+    generation, offset = _parse_cursor(cursor)
+
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        current = '{}.{:x}'.format(stat.st_ino,
+                                   zlib.crc32(str(started).encode('utf-8')))
+        reset = (offset > 0 and generation != current) or offset > stat.st_size
+        if reset:
+            offset = 0
+
+        f.seek(offset)
+        chunk = f.read(size)
+
+    # Only return complete lines.
+    end = chunk.rfind(b'\n') + 1
+    if end == 0 and len(chunk) == size:
+        end = len(chunk)
+    chunk = chunk[:end]
+
+    lines = chunk.decode('utf-8', 'ignore').splitlines(keepends=True)
+    return lines, '{}:{}'.format(current, offset + end), reset
+
+def _job_output(objectId, cursor=None):
     # Get job from server.
     Job = Object.factory('Job')
     job = Job.Query.get(objectId=objectId)
 
-    output = None
-    with open(job.outputPath, 'r') as f:
-        output = f.readlines()
+    # Without a cursor, return the whole output.
+    if cursor is None:
+        output = None
+        with open(job.outputPath, 'r') as f:
+            output = f.readlines()
+
+        return jsonify({'result': output})
+
+    if not os.path.isfile(job.outputPath):
+        return jsonify({'result': [], 'cursor': 0,
+                        'reset': _parse_cursor(cursor)[1] > 0})
+
+    lines, cursor, reset = _read_output(job.outputPath, cursor,
+                                        getattr(job, 'startedAt', None))
+    return jsonify({'result': lines, 'cursor': cursor, 'reset': reset})
+
+# Output streams are limited in number, and each is closed after
+# OUTPUT_STREAM_DURATION seconds. Clients then reconnect with the id of the
+# last event they received (Last-Event-ID), so no output is lost.
+OUTPUT_STREAM_INTERVAL = 1
+OUTPUT_STREAM_LIMIT = int(os.getenv('WEBHOOK_STREAMS', 8))
+OUTPUT_STREAM_DURATION = int(os.getenv('WEBHOOK_STREAM_DURATION', 300))
+OUTPUT_STREAM_RETRY = 10
+output_streams = Slots(os.path.join(Config.get()['dataPath'], 'webhook_streams'),
+                       OUTPUT_STREAM_LIMIT)
+def _job_output_stream(objectId, cursor=None):
+    # Get job from server.
+    Job = Object.factory('Job')
+    job = Job.Query.get(objectId=objectId)
+    path = job.outputPath
+
+    def generate(cursor):
+        started = getattr(job, 'startedAt', None)
+        opened = time.time()
+        last_check = opened
+
+        # Ask the client to reconnect soon after the stream is closed.
+        yield 'retry: {}\n\n'.format(OUTPUT_STREAM_INTERVAL * 1000)
+        while time.time() - opened < OUTPUT_STREAM_DURATION:
+            lines = []
+            reset = False
+            if os.path.isfile(path):
+                lines, cursor, reset = _read_output(path, cursor, started)
+
+            if reset:
+                yield 'event: reset\ndata: \n\n'
+            if lines:
+                data = ''.join('data: {}\n'.format(line.rstrip('\n')) for line in lines)
+                yield 'id: {}\n{}\n'.format(cursor, data)
+                continue
 
-    return jsonify({'result': output})
+            # No new output. Periodically check whether the job is still
+            # running, and close the stream when it is done.
+            if time.time() - last_check > 10 * OUTPUT_STREAM_INTERVAL:
+                last_check = time.time()
+                current = Job.Query.get(objectId=objectId)
+                started = getattr(current, 'startedAt', None)
+                if current.status != 'running':
+                    yield 'event: done\ndata: {}\n\n'.format(current.status)
+                    return
+
+            time.sleep(OUTPUT_STREAM_INTERVAL)
+
+    return Response(stream_with_context(generate(cursor)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 def _sample_citation(objectId):
     # Get project from server.
     Sample = Object.factory('Sample')
     sample = Sample.Query.get(objectId=objectId)
 
-    config = Config.get()
-
-    genus = sample.reference.organism.genus
-    species = sample.reference.organism.species
-    ref_version = sample.reference.version
-
-    arg = '-b {} --bias'.format(config['kallistoBootstraps'])
-
-    if sample.readType == 'single':
-        arg += ' --single -l {} -s {}'.format(sample.readLength,
-                                              sample.readStd)
-
-    format_dict = {'genus': genus,
-                   'species': species,
-                   'ref_version': ref_version,
-                   'arg': arg,
-                   **config}
-
-    info = ['RNA-seq data was analyzed with the Alaska pipeline (alaska.caltech.edu).',
-            ('Quality control was performed using using Bowtie2 (v{versionBowtie}), '
-             'Samtools (v{versionSamtools}), RSeQC (v{versionRseqc}), '
-             'FastQC (v{versionFastqc}), with results aggregated with '
-             'MultiQC (v{versionMultiqc}).').format(**format_dict),
-            ('Reads were aligned to the {genus} {species} genome version {ref_version} '
-             'as provided by Wormbase using Kallisto (v{versionKallisto}) with the following '
-             'flags: {arg}').format(**format_dict),
-            ('Differential expression analyses with Sleuth (v{versionSleuth}) '
-             'were performed using a Wald Test corrected for multiple-testing.').format(**format_dict)]
-
-    if genus == 'caenorhabditis' and species == 'elegans':
-        info.append('Enrichment analysis was performed using the Wormbase Enrichment Suite.')
-
+    info = sample_citation_info(sample, Config.get())
     return jsonify({'result': info})
 
 def _project_citation(objectId):
@@ -829,12 +1071,7 @@ def _project_citation(objectId):
         species = sample.reference.organism.species
         ref_version = sample.reference.version
 
-        arg = '-b {} --bias'.format(config['kallistoBootstraps'])
-
-        if sample.readType == 'single':
-            arg += ' --single -l {} -s {}'.format(sample.readLength,
-                                                  sample.readStd)
-
+        arg = kallisto_flags(sample, config)
         args += '{}({}):\t{}.\n'.format(sample.objectId, sample.name, arg)
 
 
@@ -887,18 +1124,21 @@ def _project_citation(objectId):
 
     return jsonify({'result': info})
 
-def _project_compile(project):
-    objectId = project.objectId
+def _project_compile(task, objectId):
+    Project = Object.factory('Project')
 
     with app.app_context():
         try:
             _project_email(objectId, 'Compilation started for project {}'.format(objectId),
                            'Alaska has started compiling project {} for GEO submission.'.format(objectId))
 
+            # Compilation is CPU-heavy, so it is run in a separate process.
             with configure_scope() as scope:
                 scope.set_tag('compile', objectId)
-                compile(project)
+                task.run_in_process(run_compile, objectId)
 
+            # The project was changed by the compilation.
+            project = Project.Query.get(objectId=objectId)
             project.progress = 'compiled'
             project.save()
 
@@ -906,6 +1146,7 @@ def _project_compile(project):
                            ('Alaska has finished compiling project {} for GEO submission. '
                             'Please visit the unique URL to submit.').format(objectId))
         except Exception as e:
+            project = Project.Query.get(objectId=objectId)
             project.progress = 'success'
             project.save()
             _project_email(objectId, 'Compiliation failed for project {}'.format(objectId),
@@ -913,9 +1154,11 @@ def _project_compile(project):
                             '<br>{}<br>'
                             'Please submit an issue on Github if '
                             'this keeps happening.').format(objectId, str(e)))
+            raise
+
+def _project_upload(task, objectId, geo_username, host, username, password):
+    Project = Object.factory('Project')
 
-def _project_upload(project, host, username, password, geo_username):
-    objectId = project.objectId
     with app.app_context():
         try:
             _project_email(objectId, 'Submission started for project {}'.format(objectId),
@@ -926,9 +1169,11 @@ def _project_upload(project, host, username, password, geo_username):
             file = '{}_files.tar.gz'.format(geo_username)
             with configure_scope() as scope:
                 scope.set_tag('upload', objectId)
-                upload(project, host, username, password, file)
+                task.run_in_process(run_upload, objectId, host, username,
+                                    password, geo_username)
 
             # Once done, update progress.
+            project = Project.Query.get(objectId=objectId)
             project.progress = 'uploaded'
             project.save()
 
@@ -944,6 +1189,7 @@ def _project_upload(project, host, username, password, geo_username):
                             'Failure to submit this form may result in the removal '
                             'of your data!').format(objectId, Config.get()['geoForm'], file))
         except Exception as e:
+            project = Project.Query.get(objectId=objectId)
             project.progress = 'compiled'
             project.save()
             _project_email(objectId, 'Upload failed for project {}'.format(objectId),
@@ -951,6 +1197,7 @@ def _project_upload(project, host, username, password, geo_username):
                             '<br>{}<br>'
                             'Please submit an issue on Github if '
                             'this keeps happening.').format(objectId, str(e)))
+            raise
 
 def _project_get(objectId, code, name):
     # Get project from server.
@@ -1040,11 +1287,11 @@ def _project_sleuth_close(objectId):
         return jsonify({'result': 'not found'})
 
 
-def _project_reads(objectId):
-    # Get project from server.
-    Project = Object.factory('Project')
-    project = Project.Query.get(objectId=objectId)
-
+def _find_reads(project):
+    '''
+    Helper function to find all reads in the read directory of the project.
+    Returns a dictionary of folder name to list of reads.
+    '''
     extensions = Config.get()['readExtensions']
 
     reads = {}
@@ -1065,14 +1312,27 @@ def _project_reads(objectId):
                 reads[name].append({'path': path, 'size': size})
                 print(path, file=sys.stderr)
 
-    return jsonify({'result': reads})
+    return reads
+
+def _project_reads(objectId):
+    # Get project from server.
+    Project = Object.factory('Project')
+    project = Project.Query.get(objectId=objectId)
+
+    return jsonify({'result': _find_reads(project)})
+
+def _project_md5(objectId):
+    # Get project from server.
+    Project = Object.factory('Project')
+    project = Project.Query.get(objectId=objectId)
+
+    reads = _find_reads(project)
+    paths = [read['path'] for folder in reads.values() for read in folder]
+
+    return jsonify({'result': checksums.submit_many(paths)})
 
 def _read_md5(path):
-    hash_md5 = hashlib.md5()
-    with open(path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            hash_md5.update(chunk)
-    return jsonify({'result': hash_md5.hexdigest()})
+    return jsonify({'result': checksums.submit(path)})
 
 def _read_delete(path):
     if os.path.isfile(path):
@@ -1182,32 +1442,59 @@ def _project_email(objectId, subject, message):
     return jsonify({'result': email_file})
 
 def cleanup_progress():
+    '''
+    Resets the progress of projects that were being compiled or uploaded,
+    except for the ones whose tasks are still queued or running.
+    '''
     print('cleaning up progresses')
     Project = Object.factory('Project')
     projects = Project.Query.all().filter(progress='compiling')
     print(projects)
     for project in projects:
-        project.progress = 'success'
-        project.save()
+        if not tasks.active('compile', project.objectId):
+            project.progress = 'success'
+            project.save()
 
     projects = Project.Query.all().filter(progress='uploading')
     print(projects)
     for project in projects:
-        project.progress = 'compiled'
-        project.save()
+        if not tasks.active('upload', project.objectId):
+            project.progress = 'compiled'
+            project.save()
 
 def set_version():
     print('setting version to {}'.format(VERSION))
     Function('setVersion')(version=VERSION)
 
-if __name__ == '__main__':
+tasks.register('compile', _project_compile, limit=task_limits['compile'], priority=1)
+tasks.register('upload', _project_upload, limit=task_limits['upload'], priority=0,
+               secrets=True)
+tasks.register('index', _referencesBuild, limit=task_limits['index'], priority=2)
+
+def startup():
+    '''
+    Prepares the webhook to serve requests. Called once by every process that
+    serves the application, either below or by each gunicorn worker.
+    '''
     print('Waiting 5 seconds for server.')
     time.sleep(5)
 
-    # Set version.
-    set_version()
+    # Resume unfinished tasks.
+    first = state.boot(boot_id())
+    tasks.resume()
+
+    # Set version and cleanup progress once per start of the webhook.
+    if first:
+        set_version()
+        cleanup_progress()
+
+if __name__ == '__main__':
+    # Development server. In production, the webhook is served by gunicorn
+    # with gunicorn.conf.py, which handles SIGTERM itself.
+    startup()
 
-    # Cleanup progress.
-    cleanup_progress()
+    # Handle SIGTERM gracefully.
+    signal.signal(signal.SIGTERM, sigterm_handler)
 
-    app.run(debug=True, host='0.0.0.0')
+    debug = os.getenv('WEBHOOK_DEBUG', 'false').lower() == 'true'
+    app.run(debug=debug, use_reloader=False, threaded=True, host='0.0.0.0')
@@ -4,8 +4,11 @@ import time
 import docker
 import signal
 import time
+import requests
 import traceback
 import datetime as dt
+from contextlib import ExitStack
+from threading import Thread, Condition, Lock
 
 # Set up sentry.
 import sentry_sdk
@@ -15,9 +18,9 @@ sentry_sdk.init(os.getenv('SENTRY_WORKER_DSN', ''), environment=os.getenv('ENVIR
 def sigterm_handler(signal, frame):
     print('SIGTERM received', flush=True)
 
-    # Gracefully stop container.
-    print(container, flush=True)
-    if container is not None:
+    # Gracefully stop all running containers.
+    print(containers, flush=True)
+    for container in list(containers.values()):
         try:
             print('sending SIGTERM to container {}'.format(container.name),
                   flush=True)
@@ -36,6 +39,7 @@ signal.signal(signal.SIGTERM, sigterm_handler)
 PARSE_HOSTNAME = os.getenv('PARSE_HOSTNAME', 'http://parse-server:1337/parse')
 PARSE_APP_ID = os.getenv('PARSE_APP_ID', 'alaska')
 PARSE_MASTER_KEY = os.getenv('PARSE_MASTER_KEY', 'MASTER_KEY')
+WEBHOOK_HOSTNAME = os.getenv('WEBHOOK_HOSTNAME', 'http://webhook:5000')
 print(PARSE_HOSTNAME, PARSE_APP_ID, PARSE_MASTER_KEY)
 
 # Setup for parse_rest
@@ -49,24 +53,167 @@ from parse_rest.connection import ParseBatcher
 from parse_rest.core import ResourceRequestBadRequest, ParseError
 register(PARSE_APP_ID, '', master_key=PARSE_MASTER_KEY)
 
-def dequeue():
+sys.path.append(Config.get()['scriptPath'])
+from utilities import parse_cpuset
+
+class SlotScheduler:
+    """
+    Splits the configured cpu set into slots, one for each running job.
+    Each job is given its own subset of cpus, so that small jobs can be packed
+    next to long-running ones.
+    """
+    def __init__(self, cpus, max_jobs=None):
+        self.cpus = parse_cpuset(cpus)
+        self.free = list(self.cpus)
+        self.max_jobs = max_jobs
+        self.running = 0
+        self.lock = Lock()
+
+    def acquire(self, n):
+        """
+        Reserves n cpus. Returns the list of reserved cpu ids, or None if
+        there are not enough free cpus.
+        """
+        n = max(1, min(n, len(self.cpus)))
+        with self.lock:
+            if self.max_jobs is not None and self.running >= self.max_jobs:
+                return None
+            if len(self.free) < n:
+                return None
+
+            cpus = self.free[:n]
+            self.free = self.free[n:]
+            self.running += 1
+
+            return cpus
+
+    def release(self, cpus):
+        with self.lock:
+            self.free = sorted(self.free + cpus)
+            self.running -= 1
+
+# The first runnable job of the queue, and how long it has been waiting for
+# enough free cpus.
+head = {'id': None, 'since': None, 'skips': 0}
+
+def dequeue(scheduler, config):
+    """
+    Finds the first queued job that can be run right now.
+    A job can be run if no other job of the same project is running, and
+    there are enough free cpus for the number of threads it requires.
+    The threads of each analysis are set by the analysisThreads config,
+    which maps analysis codes to numbers of threads, and default to threads.
+    Jobs that do not fit are skipped, so that smaller jobs further down the
+    queue may be packed onto the remaining cpus.
+    To keep a large job from starving behind small ones, the first runnable
+    job reserves the cpus once it has been skipped headSkips times or for
+    headWait seconds. No other job is started until it fits.
+
+    Returns a (job, cpus) tuple if a job was started, False if there is
+    no job to start, and None if an error occurred.
+    """
     try:
         Job = Object.factory('Job')
-        jobs = Job.Query.filter(queuePosition__gte=0).order_by('queuePosition').limit(1)
+        jobs = Job.Query.filter(queuePosition__gte=0).order_by('queuePosition') \
+                        .select_related('analysis')
+        analysis_threads = config.get('analysisThreads', {})
+
+        # Jobs of the same project must run in order.
+        blocked = set(running.values())
+        waiting = None
+        for job in jobs:
+            project_id = job.project.objectId
+            if project_id in blocked:
+                continue
+            blocked.add(project_id)
+
+            threads = analysis_threads.get(job.analysis.code, config['threads'])
+            cpus = scheduler.acquire(threads)
+            if cpus is None:
+                if waiting is not None:
+                    continue
+                waiting = job.objectId
 
-        if jobs:
-            job = jobs[0]
-            Function('jobStarted')(objectId=job.objectId)
-            return Job.Query.get(objectId=job.objectId)
-        else:
-            return False
+                if head['id'] != waiting:
+                    head.update(id=waiting, since=time.time(), skips=0)
+                if (head['skips'] >= config.get('headSkips', 10)
+                        or time.time() - head['since'] >= config.get('headWait', 600)):
+                    return False
+                continue
+
+            if waiting is None:
+                head.update(id=None, since=None, skips=0)
+            else:
+                head['skips'] += 1
+
+            try:
+                Function('jobStarted')(objectId=job.objectId)
+                job = Job.Query.get(objectId=job.objectId)
+            except Exception as e:
+                scheduler.release(cpus)
+                raise e
+
+            running[job.objectId] = project_id
+            return job, cpus
+
+        return False
     except Exception as e:
         capture_exception(e)
 
-def wait():
-    # Get wait time.
-    interval = Config.get()['workerInterval']
-    time.sleep(interval)
+# Queue notification state.
+QUEUE_TIMEOUT = 60
+MIN_BACKOFF = 1
+queue_seq = -1
+backoff = MIN_BACKOFF
+def wait(max_interval):
+    '''
+    Blocks until a job may have been enqueued.
+    The webhook's /queue/wait endpoint is long-polled, and this function only
+    returns when the queue sequence number changes, so Parse is not queried
+    while the queue is empty. The sequence number changes whenever a job is
+    enqueued, and is reseeded randomly when the webhook restarts, so
+    notifications that were lost while the webhook was down are recovered
+    once it is back. If the webhook can not be reached, it is retried with
+    exponential backoff, capped at max_interval seconds.
+    '''
+    global queue_seq, backoff
+
+    while True:
+        try:
+            r = requests.post(WEBHOOK_HOSTNAME + '/queue/wait',
+                              params={'seq': queue_seq, 'timeout': QUEUE_TIMEOUT},
+                              timeout=QUEUE_TIMEOUT + 10)
+            r.raise_for_status()
+            seq = r.json()['result']
+            backoff = MIN_BACKOFF
+
+            if seq != queue_seq:
+                queue_seq = seq
+                return
+        except Exception as e:
+            print('queue channel unavailable, retrying in {} seconds'.format(backoff),
+                  flush=True)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_interval)
+
+# Condition that is notified whenever the main loop should try to dequeue,
+# either because a new job was enqueued or because a running job finished.
+wakeup = Condition()
+woken = True
+def notify():
+    global woken
+
+    with wakeup:
+        woken = True
+        wakeup.notify_all()
+
+def listen(max_interval):
+    """
+    Thread target that relays queue notifications from the webhook.
+    """
+    while True:
+        wait(max_interval)
+        notify()
 
 def check_images():
     index_image = Config.get()['indexImage']
@@ -86,146 +233,322 @@ def check_images():
             sys.exit(1)
 
 
-# Global variable for container.
-container = None
-def start():
-    global container
-
+class JobLog:
+    """
+    Buffered writer for the output of a job.
+    The output file is kept open and written to in chunks, and detected
+    commands are saved to Parse in batches by flush_logs(), instead of
+    once per line.
+    Saves of the commands are serialized by save_lock, and each records the
+    version of the commands it sent, so that an older list of commands is
+    never sent after a newer one.
+    """
+    def __init__(self, job, path, flush_size=64 * 1024):
+        self.job = job
+        self.file = open(path, 'a')
+        self.flush_size = flush_size
+        self.buffer = []
+        self.size = 0
+        self.version = 0
+        self.saved = 0
+        self.lock = Lock()
+        self.save_lock = Lock()
+
+    def write(self, line):
+        with self.lock:
+            self.buffer.append(line + '\n')
+            self.size += len(line) + 1
+
+            # Detect commands.
+            if line.startswith('##'):
+                self.job.commands.append(line.strip('# '))
+                self.version += 1
+
+            if self.size >= self.flush_size:
+                self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.file.flush()
+            self.buffer = []
+            self.size = 0
+
+    def flush(self):
+        """
+        Writes any buffered output to the file.
+        Returns True if there are commands that have not been saved to Parse.
+        """
+        with self.lock:
+            self._flush()
+            return self.version > self.saved
+
+    def _snapshot(self):
+        # Returns the version and commands to save, or None if they are saved.
+        with self.lock:
+            if self.version <= self.saved:
+                return None
+            return self.version, list(self.job.commands)
+
+    def _saved(self, version):
+        with self.lock:
+            self.saved = max(self.saved, version)
+
+    def _put(self, commands, batch=False):
+        # Only the commands are saved. The rest of the job object is stale,
+        # and saving it would revert fields that are set by cloud code in the
+        # meantime (i.e. the status set by jobSuccess).
+        return self.job.__class__.PUT(self.job._absolute_url, batch=batch,
+                                      commands=commands)
+
+    def save(self):
+        """
+        Saves the commands of the job, unless they are already saved.
+        """
+        with self.save_lock:
+            snapshot = self._snapshot()
+            if snapshot is None:
+                return
+            version, commands = snapshot
+
+            self._put(commands)
+            self._saved(version)
+
+    def save_request(self):
+        """
+        Returns the request and callback that save the commands of the job,
+        to be passed to ParseBatcher().batch(), or None if they are already
+        saved. save_lock must be held until the batch is sent.
+        """
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return None
+        version, commands = snapshot
+
+        return self._put(commands, batch=True), lambda response: self._saved(version)
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.file.close()
+
+        self.save()
+
+# Output logs of running jobs.
+logs = set()
+LOG_INTERVAL = 1
+BATCH_SIZE = 50
+def flush_logs():
+    """
+    Thread target that periodically flushes the output of all running jobs,
+    and saves the commands of all jobs with new commands in batched requests.
+    """
     while True:
-        # Dequeue job.
-        job = dequeue()
+        time.sleep(LOG_INTERVAL)
 
-        if job:
-            try:
-                project = job.project
-                analysis = job.analysis
-                print('Retrieved job {} for project {}'.format(job.objectId,
-                                                               project.objectId),
-                      flush=True)
-
-                # Make directory if it doesn't exist.
-                if analysis.code not in project.paths:
-                    path = os.path.join(project.paths['root'], analysis.code)
+        try:
+            dirty = [log for log in list(logs) if log.flush()]
+            for i in range(0, len(dirty), BATCH_SIZE):
+                # Hold the save locks until the batch is sent, so that a log
+                # that is closed meanwhile saves after it.
+                with ExitStack() as stack:
+                    for log in dirty[i:i+BATCH_SIZE]:
+                        stack.enter_context(log.save_lock)
+                    saves = [log.save_request() for log in dirty[i:i+BATCH_SIZE]]
+                    ParseBatcher().batch([lambda batch, request=request: request
+                                          for request in saves
+                                          if request is not None])
+        except Exception as e:
+            capture_exception(e)
+            print(traceback.format_exc(), file=sys.stderr, flush=True)
+
+# Running containers and jobs, keyed by job objectId.
+containers = {}
+running = {}
+def run_job(job, cpus, scheduler):
+    """
+    Runs a single job on the given cpus. Blocks until the job is finished.
+    """
+    try:
+        project = job.project
+        analysis = job.analysis
+        print('Retrieved job {} for project {} on cpus {}'.format(job.objectId,
+                                                                  project.objectId,
+                                                                  cpus),
+              flush=True)
+
+        # Make directory if it doesn't exist.
+        if analysis.code not in project.paths:
+            path = os.path.join(project.paths['root'], analysis.code)
+            os.makedirs(path, exist_ok=True)
+
+            project.paths[analysis.code] = path
+            project.save()
+        # Also for each sample, if it needs one.
+        if analysis.type == 'sample':
+            samples = project.relation('samples').query()
+
+            for sample in samples:
+                if analysis.code not in sample.paths:
+                    path = os.path.join(project.paths[analysis.code], sample.name)
                     os.makedirs(path, exist_ok=True)
 
-                    project.paths[analysis.code] = path
-                    project.save()
-                # Also for each sample, if it needs one.
-                if analysis.type == 'sample':
-                    samples = project.relation('samples').query()
-
-                    for sample in samples:
-                        if analysis.code not in sample.paths:
-                            path = os.path.join(project.paths[analysis.code], sample.name)
-                            os.makedirs(path, exist_ok=True)
-
-                            sample.paths[analysis.code] = path
-                            sample.save()
-
-
-                config = Config.get()
-                data_volume = config['repoName'] + '_' + config['dataVolume']
-                data_path = config['dataPath']
-                script_volume = config['repoName'] + '_' + config['scriptVolume']
-                script_path = config['scriptPath']
-                network = config['repoName'] + '_' + config['backendNetworkName']
-                cpus = config['cpus']
-
-                # begin container variables.
-                cmd = 'python3 -u {} {} {}'.format(analysis.script,
-                                                   project.objectId,
-                                                   analysis.code)
-                if getattr(analysis, 'requires', None) is not None:
-                    cmd += ' ' + analysis.requires.code
-                if job.archive:
-                    cmd += ' --archive'
-
-                volumes = {
-                    data_volume: {'bind': data_path, 'mode': 'rw'},
-                    script_volume: {'bind': script_path, 'mode': 'rw'}
-                }
-                environment = {
-                    'PARSE_HOSTNAME': PARSE_HOSTNAME,
-                    'PARSE_APP_ID': PARSE_APP_ID,
-                    'PARSE_MASTER_KEY': PARSE_MASTER_KEY,
-                    'ENVIRONMENT': os.getenv('ENVIRONMENT', 'default'),
-                    'SENTRY_QC_DSN': os.getenv('SENTRY_QC_DSN', ''),
-                    'SENTRY_QUANT_DSN': os.getenv('SENTRY_QUANT_DSN', ''),
-                    'SENTRY_DIFF_DSN': os.getenv('SENTRY_DIFF_DSN', ''),
-                    'SENTRY_POST_DSN': os.getenv('SENTRY_POST_DSN', '')
-                }
-                wdir = script_path
-                name = '{}-{}'.format(analysis.code, project.objectId)
-
-                # output path.
-                output_file = '{}_output.txt'.format(analysis.code)
-                output_path = os.path.join(project.paths[analysis.code], output_file)
-                job.outputPath = output_path
-                start = time.time()
-                job.save()
-
-                # Remove output file if it already exists.
-                if os.path.exists(output_path):
-                    os.remove(output_path)
-
-                progress = config['progress']
-                key = analysis.code + '_started'
-                if key in progress:
-                    project.oldProgress = progress[key]
-                    project.save()
-
-                # Docker client.
-                client = docker.from_env()
-                container = client.containers.run(analysis.image, cmd, detach=True,
-                                                  auto_remove=True, volumes=volumes,
-                                                  working_dir=wdir, cpuset_cpus=cpus,
-                                                  network=network, environment=environment,
-                                                  name=name)
-                print('started container with id {} and name {}'.format(container.id, name))
-                hook = container.logs(stdout=True, stderr=True, stream=True)
-                for line in hook:
-                    decoded = line.decode('utf-8').strip().encode('ascii', 'ignore').decode('ascii')
-
-                    if '\n' in decoded:
-                        outs = decoded.split('\n')
-                    else:
-                        outs = [decoded]
-
-                    for out in outs:
-                        # Detect commands.
-                        if out.startswith('##'):
-                            job.commands.append(out.strip('# '))
-                            job.save()
-
-                        # Save output.
-                        print(out, flush=True)
-                        with open(output_path, 'a') as f:
-                            f.write(out + '\n')
-
-                # Container finished.
-                exitcode = container.wait()['StatusCode']
-                runtime = time.time() - start
-
-                if exitcode != 0:
-                    log = container.attach(stdout=True, stderr=True, stream=False, logs=True)
-                    msg = 'container {} exited with code {}\n{}'.format(name, exitcode, log)
-                    raise Exception(msg)
+                    sample.paths[analysis.code] = path
+                    sample.save()
+
+
+        config = Config.get()
+        data_volume = config['repoName'] + '_' + config['dataVolume']
+        data_path = config['dataPath']
+        script_volume = config['repoName'] + '_' + config['scriptVolume']
+        script_path = config['scriptPath']
+        network = config['repoName'] + '_' + config['backendNetworkName']
+
+        # begin container variables.
+        cmd = 'python3 -u {} {} {}'.format(analysis.script,
+                                           project.objectId,
+                                           analysis.code)
+        if getattr(analysis, 'requires', None) is not None:
+            cmd += ' ' + analysis.requires.code
+        if job.archive:
+            cmd += ' --archive'
+
+        volumes = {
+            data_volume: {'bind': data_path, 'mode': 'rw'},
+            script_volume: {'bind': script_path, 'mode': 'rw'}
+        }
+        environment = {
+            'PARSE_HOSTNAME': PARSE_HOSTNAME,
+            'PARSE_APP_ID': PARSE_APP_ID,
+            'PARSE_MASTER_KEY': PARSE_MASTER_KEY,
+            'ENVIRONMENT': os.getenv('ENVIRONMENT', 'default'),
+            'SENTRY_QC_DSN': os.getenv('SENTRY_QC_DSN', ''),
+            'SENTRY_QUANT_DSN': os.getenv('SENTRY_QUANT_DSN', ''),
+            'SENTRY_DIFF_DSN': os.getenv('SENTRY_DIFF_DSN', ''),
+            'SENTRY_POST_DSN': os.getenv('SENTRY_POST_DSN', ''),
+            'THREADS': str(len(cpus)),
+            'ARCHIVE_LEVEL': str(config.get('archiveLevel', 6))
+        }
+        wdir = script_path
+        name = '{}-{}'.format(analysis.code, project.objectId)
+
+        # output path.
+        output_file = '{}_output.txt'.format(analysis.code)
+        output_path = os.path.join(project.paths[analysis.code], output_file)
+        job.outputPath = output_path
+        start = time.time()
+        job.save()
+
+        # Replace the output file with a new, empty one. The new file is
+        # created before the old one is removed, so it never has the same
+        # inode, which lets the webhook tell the runs of the job apart.
+        tmp_path = output_path + '.tmp'
+        open(tmp_path, 'w').close()
+        os.replace(tmp_path, output_path)
+
+        progress = config['progress']
+        key = analysis.code + '_started'
+        if key in progress:
+            project.oldProgress = progress[key]
+            project.save()
+
+        # Docker client.
+        client = docker.from_env()
+        container = client.containers.run(analysis.image, cmd, detach=True,
+                                          auto_remove=True, volumes=volumes,
+                                          working_dir=wdir,
+                                          cpuset_cpus=','.join(str(cpu) for cpu in cpus),
+                                          network=network, environment=environment,
+                                          name=name)
+        containers[job.objectId] = container
+        print('started container with id {} and name {}'.format(container.id, name))
+        log = JobLog(job, output_path)
+        logs.add(log)
+        hook = container.logs(stdout=True, stderr=True, stream=True)
+        try:
+            for line in hook:
+                decoded = line.decode('utf-8').strip().encode('ascii', 'ignore').decode('ascii')
+
+                if '\n' in decoded:
+                    outs = decoded.split('\n')
                 else:
-                    print('{} success'.format(container.name))
-                    Function('jobSuccess')(objectId=job.objectId, runtime=runtime)
-                    continue
-            except Exception as e:
-                capture_exception(e)
-                print(traceback.format_exc(), file=sys.stderr, flush=True)
+                    outs = [decoded]
+
+                for out in outs:
+                    # Save output.
+                    print('{}: {}'.format(name, out), flush=True)
+                    log.write(out)
+        finally:
+            logs.discard(log)
+            log.close()
+
+        # Container finished.
+        exitcode = container.wait()['StatusCode']
+        runtime = time.time() - start
+
+        if exitcode != 0:
+            log = container.attach(stdout=True, stderr=True, stream=False, logs=True)
+            msg = 'container {} exited with code {}\n{}'.format(name, exitcode, log)
+            raise Exception(msg)
+        else:
+            print('{} success'.format(container.name))
+            Function('jobSuccess')(objectId=job.objectId, runtime=runtime)
+    except Exception as e:
+        capture_exception(e)
+        print(traceback.format_exc(), file=sys.stderr, flush=True)
+
+        # Notify that there was an error.
+        Function('jobError')(objectId=job.objectId)
+
+    finally:
+        containers.pop(job.objectId, None)
+        running.pop(job.objectId, None)
+        scheduler.release(cpus)
+
+        # Freed cpus may allow another job to start.
+        notify()
+
+def start():
+    global woken
+
+    config = Config.get()
+
+    # Upper bound for the backoff when the webhook or Parse is unavailable.
+    max_interval = config['workerInterval']
 
-                # Notify that there was an error.
-                Function('jobError')(objectId=job.objectId)
+    # Split the cpus among concurrently running jobs.
+    scheduler = SlotScheduler(config['cpus'], config.get('workerJobs'))
 
-            finally:
-                container = None
+    listener = Thread(target=listen, args=(max_interval,))
+    listener.daemon = True
+    listener.start()
 
-        # Wait.
-        wait()
+    flusher = Thread(target=flush_logs)
+    flusher.daemon = True
+    flusher.start()
+
+    while True:
+        # Wait until a job may be available.
+        with wakeup:
+            wakeup.wait_for(lambda: woken)
+            woken = False
+
+        # Start as many jobs as will fit.
+        while True:
+            result = dequeue(scheduler, Config.get())
+
+            if result is None:
+                # Parse could not be reached.
+                time.sleep(max_interval)
+                notify()
+                break
+            elif not result:
+                break
+
+            job, cpus = result
+            t = Thread(target=run_job, args=(job, cpus, scheduler))
+            t.daemon = True
+            t.start()
 
 
 if __name__ == '__main__':